@@ -0,0 +1,388 @@
+#!/usr/bin/python3
+
+import argparse
+import gc
+import logging
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import OrderedDict
+import bptc
+from bptc.data import consensus, consensus_reference
+from bptc.data.db import DB
+from bptc.data.event import Event, Parents
+from bptc.data.hashgraph import ConsensusView
+from bptc.data.transaction import MoneyTransaction
+from bptc.protocols.codec import JSONCodec, BinaryCodec, CachedBinaryCodec, EventRecordCache
+from bptc.utils.generator import generate_events, generate_hashgraph, create_hashgraph, create_member, TOPOLOGIES
+from bptc.utils import verification
+
+"""Benchmarks of the hashgraph implementation. They run on synthetic hashgraphs - no network is needed."""
+
+
+def benchmark_memory(args):
+    """Measures the memory needed per event."""
+    gc.collect()
+    tracemalloc.start()
+    hg = generate_hashgraph(args.members, args.events, args.topology, args.forks, args.seed)
+    gc.collect()
+    graph_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    # The layout before the events were slotted: all attributes in a __dict__, plus the dicts for votes and
+    # visibility every event carried
+    class DictEvent:
+        pass
+
+    slotted_bytes = 0
+    dict_bytes = 0
+    for event in hg.events:
+        slotted_bytes += sys.getsizeof(event)
+        dict_event = DictEvent()
+        for attribute in Event.__slots__:
+            attribute = '_Event' + attribute if attribute.startswith('__') else attribute
+            setattr(dict_event, attribute, getattr(event, attribute))
+        dict_event.votes = dict()
+        dict_event.can_see_cache = dict()
+        dict_bytes += sys.getsizeof(dict_event) + sys.getsizeof(dict_event.__dict__) + \
+            sys.getsizeof(dict_event.votes) + sys.getsizeof(dict_event.can_see_cache)
+
+    n = len(hg.events)
+    print('{} events by {} members, {} ordered'.format(n, args.members, len(hg.ordered_events)))
+    print('Whole hashgraph:        {:8.0f} bytes/event'.format(graph_bytes / n))
+    print('Event object (dict):    {:8.0f} bytes/event'.format(dict_bytes / n))
+    print('Event object (slotted): {:8.0f} bytes/event'.format(slotted_bytes / n))
+
+
+def run_consensus(members, events, batch_size, engine=consensus):
+    """
+    Adds events to a new hashgraph in batches and calculates the consensus after each batch
+    :param members: The members
+    :param events: The events, in topological order
+    :param batch_size: The number of events added between consensus calculations
+    :param engine: The module implementing the consensus
+    :return: The hashgraph and the seconds spent in each phase
+    """
+    hg = create_hashgraph(members)
+    timings = OrderedDict((phase, 0.0) for phase in ['add_event', 'divide_rounds', 'decide_fame', 'find_order'])
+
+    for i in range(0, len(events), batch_size):
+        batch = events[i:i + batch_size]
+
+        start = time.perf_counter()
+        for event in batch:
+            hg.add_event(event)
+        timings['add_event'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine.divide_rounds(hg, batch)
+        timings['divide_rounds'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine.decide_fame(hg)
+        timings['decide_fame'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        engine.find_order(hg)
+        timings['find_order'] += time.perf_counter() - start
+
+    return hg, timings
+
+
+def benchmark_consensus(args):
+    """Measures the time of the consensus phases for several graph sizes."""
+    print('{:>8} {:>8} {:>8} | {:>10} {:>13} {:>11} {:>10} | {:>10}'.format(
+        'members', 'events', 'ordered', 'add_event', 'divide_rounds', 'decide_fame', 'find_order', 'events/s'))
+    for n_events in args.events:
+        members, events = generate_events(args.members, n_events, args.topology, args.forks, args.seed)
+        hg, timings = run_consensus(members, events, args.batch_size or args.members)
+        total = sum(timings.values())
+        print('{:>8} {:>8} {:>8} | {:>8.0f}ms {:>11.0f}ms {:>9.0f}ms {:>8.0f}ms | {:>10.0f}'.format(
+            args.members, n_events, len(hg.ordered_events), *[t * 1000 for t in timings.values()],
+            n_events / total))
+
+
+def benchmark_events(args):
+    """Measures the throughput of creating, signing, encoding, decoding and verifying single events."""
+    member = create_member(args.seed + 1)
+    receiver = create_member(args.seed + 2)
+    times = OrderedDict()
+
+    start = time.perf_counter()
+    events = []
+    for i in range(args.events):
+        data = [MoneyTransaction(receiver.verify_key, i, 'Transaction {}'.format(i))] if i % 2 == 0 else None
+        events.append(Event(member.verify_key, data, Parents(events[-1].id if events else None, None)))
+    times['create'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for event in events:
+        event.sign(member.signing_key)
+    times['sign'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    dicts = [event.to_dict() for event in events]
+    times['encode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    events = [Event.from_dict(d) for d in dicts]
+    times['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if not all(event.has_valid_signature for event in events):
+        raise AssertionError('Invalid signature')
+    times['verify'] = time.perf_counter() - start
+
+    print('{:>8} | {:>10}'.format('', 'events/s'))
+    for step, seconds in times.items():
+        print('{:>8} | {:>10.0f}'.format(step, args.events / seconds))
+
+
+def benchmark_codec(args):
+    """
+    Measures the size and the time needed to encode and decode a push with each codec. The cached codec encodes
+    the events only once, so its encoding time is the one of repeated pushes.
+    """
+    hg = generate_hashgraph(args.members, args.events, args.topology, args.forks, args.seed)
+    message = {
+        'from': {'verify_key': hg.me.verify_key, 'listening_port': 8000, 'protocol_version': 3,
+                 'heads': hg.get_heads()},
+        'events': hg.lookup_table,
+        'members': []
+    }
+
+    def best_time(function, repetitions=5):
+        times = []
+        for _ in range(repetitions):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times)
+
+    print('{:<20} | {:>12} {:>12} {:>10} {:>10} {:>16}'.format(
+        'codec', 'bytes/event', 'compressed', 'encode', 'decode', 'decode (known)'))
+    for name, codec in [('json (legacy)', JSONCodec(detached_signatures=False)), ('json', JSONCodec()),
+                        ('binary', BinaryCodec()), ('binary (cached)', CachedBinaryCodec(EventRecordCache()))]:
+        data = codec.encode(message)
+        compressed = zlib.compress(data, bptc.push_compression_level or 6)
+        print('{:<20} | {:>12.0f} {:>12.0f} {:>8.0f}ms {:>8.0f}ms {:>14.0f}ms'.format(
+            name, len(data) / args.events, len(compressed) / args.events,
+            best_time(lambda: codec.encode(message)) * 1000, best_time(lambda: codec.decode(data)) * 1000,
+            best_time(lambda: codec.decode(data, hg.lookup_table)) * 1000))
+
+
+def benchmark_verification(args):
+    """Measures the throughput of the signature verification for several numbers of threads."""
+    _, events = generate_events(args.members, args.events, args.topology, args.forks, args.seed)
+    print('{:>8} | {:>10}'.format('threads', 'events/s'))
+    for workers in args.workers:
+        verification.clear_cache()
+        start = time.perf_counter()
+        if not all(verification.verify_signatures(events, workers)):
+            raise AssertionError('Invalid signature')
+        print('{:>8} | {:>10.0f}'.format(workers, len(events) / (time.perf_counter() - start)))
+
+
+def get_consensus_state(hg):
+    """
+    Returns everything the consensus decides, referring to events by their hashes
+    :return: Tuple of {event-hash => (round, is_witness, is_famous, round_received, consensus_time)} and the order
+    """
+    decisions = {e.id: (e.round, e.is_witness, e.is_famous, e.round_received, e.consensus_time) for e in hg.events}
+    return decisions, [hg.events[i].id for i in hg.ordered_events]
+
+
+def run_consensus_at_cadence(members, events, batch_size, engine, every=1, threaded=False):
+    """
+    Adds events to a new hashgraph in batches, the way received events are added, and calculates fame and order
+    through a ConsensusView like Hashgraph.calculate_consensus does
+    :param members: The members
+    :param events: The events, in topological order
+    :param batch_size: The number of events added at once
+    :param engine: The module implementing the consensus
+    :param every: The number of batches added between consensus calculations, None to calculate it once at the end
+    :param threaded: Whether a consensus thread calculates it whenever it gets to it instead
+    :return: The hashgraph and the seconds spent on the consensus
+    """
+    hg = create_hashgraph(members)
+    seconds = 0.0
+    if threaded:
+        hg.start_consensus_thread()
+
+    batches = [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+    for n, batch in enumerate(batches, 1):
+        with hg.lock:
+            for event in batch:
+                hg.add_event(event)
+            start = time.perf_counter()
+            engine.divide_rounds(hg, batch)
+            seconds += time.perf_counter() - start
+            hg.events_since_consensus += len(batch)
+
+        if threaded:
+            hg.consensus_thread.wake()
+        elif every is not None and n % every == 0:
+            start = time.perf_counter()
+            calculate_consensus(hg, engine)
+            seconds += time.perf_counter() - start
+
+    if threaded:
+        hg.stop_consensus_thread()
+
+    # Whatever was added since the last calculation
+    start = time.perf_counter()
+    calculate_consensus(hg, engine)
+    return hg, seconds + time.perf_counter() - start
+
+
+def calculate_consensus(hg, engine):
+    """Decides fame and order through a ConsensusView, see Hashgraph.calculate_consensus."""
+    if engine is consensus:
+        hg.calculate_consensus(force=True)
+        return
+
+    with hg.lock:
+        if not hg.is_consensus_due(force=True):
+            return
+        view = ConsensusView(hg)
+        engine.decide_fame(view)
+        engine.find_order(view)
+        view.publish()
+
+
+def get_differences(expected, actual):
+    """
+    Compares two results of get_consensus_state
+    :return: The hashes of the events with different decisions, and 'order' if the order is different
+    """
+    (expected_decisions, expected_order), (decisions, order) = expected, actual
+    differences = [event_id for event_id in expected_decisions if expected_decisions[event_id] != decisions[event_id]]
+    if order != expected_order:
+        differences.append('order')
+    return differences
+
+
+def compare_consensus(name, members, events, batch_size, every):
+    """
+    Calculates the consensus of a hashgraph with the reference and the optimized implementation. Each of them
+    calculates it after every batch, after every few batches and once at the end, and the optimized one in a
+    consensus thread as well. The result must not depend on when the consensus is calculated.
+    :param every: The number of batches between the calculations of the second cadence
+    :return: Whether all calculations came to the same result
+    """
+    cadences = OrderedDict([('every batch', (1, False)), ('every {} batches'.format(every), (every, False)),
+                            ('at the end', (None, False)), ('threaded', (1, True))])
+    results = OrderedDict()
+    for engine in [consensus_reference, consensus]:
+        for cadence, (cadence_every, threaded) in cadences.items():
+            if threaded and engine is consensus_reference:
+                # The reference writes its decisions to the events directly, so it can't run in a thread
+                continue
+            # Each hashgraph needs its own copies of the events
+            copies = [Event.from_dict(e.to_dict()) for e in events]
+            hg, seconds = run_consensus_at_cadence(members, copies, batch_size, engine, cadence_every, threaded)
+            results[(engine, cadence)] = (get_consensus_state(hg), seconds)
+
+    expected, reference_time = results[(consensus_reference, 'every batch')]
+    ordered = len(expected[1])
+    time_needed = results[(consensus, 'every batch')][1]
+    failures = []
+    for (engine, cadence), (state, _) in results.items():
+        differences = get_differences(expected, state)
+        if len(differences) > 0:
+            failures.append('{} {}: {}'.format('reference' if engine is consensus_reference else 'optimized', cadence,
+                                               ', '.join(d[:6] for d in differences[:5])))
+
+    print('{:<30} {:>7} {:>8} | {:>10.0f}ms {:>8.0f}ms {:>7.1f}x | {}'.format(
+        name, len(events), ordered, reference_time * 1000, time_needed * 1000, reference_time / time_needed,
+        'OK' if len(failures) == 0 else 'DIFFERENT - ' + '; '.join(failures)))
+    return len(failures) == 0
+
+
+def benchmark_compare(args):
+    """
+    Compares the optimized consensus with the reference implementation on synthetic and recorded hashgraphs, and
+    both with themselves at different cadences. The times are those of calculating the consensus after every batch.
+    """
+    print('{:<30} {:>7} {:>8} | {:>12} {:>10} {:>8} |'.format(
+        'hashgraph', 'events', 'ordered', 'reference', 'optimized', 'speedup'))
+    # A consensus thread calculates fame and order as soon as it gets to it
+    bptc.consensus_interval = 0
+    equal = True
+    for topology in TOPOLOGIES:
+        for forks in sorted({0.0, args.forks}):
+            members, events = generate_events(args.members, args.events, topology, forks, args.seed)
+            name = '{}, {:.0%} forks'.format(topology, forks)
+            equal &= compare_consensus(name, members, events, args.members, args.every)
+
+        # Forks which arrive after the fame of the forked events was (partly) decided and that others build on
+        if args.late_forks > 0:
+            members, events = generate_events(args.members, args.events, topology, args.late_forks, args.seed,
+                                              args.events // 2)
+            name = '{}, {:.0%} late forks'.format(topology, args.late_forks)
+            equal &= compare_consensus(name, members, events, args.members, args.every)
+
+    if args.db is not None:
+        hg = DB.load_hashgraph(args.db)
+        members = list(hg.known_members.values())
+        equal &= compare_consensus(args.db, members, hg.events, len(members), args.every)
+
+    if not equal:
+        sys.exit(1)
+
+
+def parse_args():
+    """Return the parsed command line arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the synthetic hashgraph')
+    parser.add_argument('-m', '--members', type=int, default=10, help='Number of members')
+    parser.add_argument('-t', '--topology', choices=TOPOLOGIES, default='random', help='Who gossips with whom')
+    parser.add_argument('-f', '--forks', type=float, default=0.0,
+                        help='Probability that an event of the last member is a fork')
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    memory_parser = subparsers.add_parser('memory', help='Measure the memory needed per event')
+    memory_parser.add_argument('-e', '--events', type=int, default=10000, help='Number of events')
+    memory_parser.set_defaults(func=benchmark_memory)
+
+    consensus_parser = subparsers.add_parser('consensus', help='Measure the time of the consensus phases')
+    consensus_parser.add_argument('-e', '--events', type=int, nargs='+', default=[1000, 5000, 20000],
+                                  help='Numbers of events')
+    consensus_parser.add_argument('-b', '--batch-size', type=int, default=None,
+                                  help='Number of events added between consensus calculations '
+                                       '(default: number of members)')
+    consensus_parser.set_defaults(func=benchmark_consensus)
+
+    events_parser = subparsers.add_parser('events', help='Measure the throughput of single events')
+    events_parser.add_argument('-e', '--events', type=int, default=10000, help='Number of events')
+    events_parser.set_defaults(func=benchmark_events)
+
+    codec_parser = subparsers.add_parser('codec', help='Measure the codecs of the push protocol')
+    codec_parser.add_argument('-e', '--events', type=int, default=2000, help='Number of events')
+    codec_parser.set_defaults(func=benchmark_codec)
+
+    verification_parser = subparsers.add_parser('verification', help='Measure the signature verification')
+    verification_parser.add_argument('-e', '--events', type=int, default=10000, help='Number of events')
+    verification_parser.add_argument('-w', '--workers', type=int, nargs='+', default=[1, 2, 4, 8],
+                                     help='Numbers of verification threads')
+    verification_parser.set_defaults(func=benchmark_verification)
+
+    compare_parser = subparsers.add_parser('compare', help='Compare the consensus with the reference implementation')
+    compare_parser.add_argument('-e', '--events', type=int, default=1000, help='Number of events')
+    compare_parser.add_argument('-l', '--late-forks', type=float, default=0.05,
+                                help='Probability that an event of the last member is a fork arriving after half of '
+                                     'the events (0 to skip)')
+    compare_parser.add_argument('-n', '--every', type=int, default=5,
+                                help='Number of batches between consensus calculations when comparing cadences')
+    compare_parser.add_argument('--db', type=str, default=None, help='Database file of a recorded hashgraph')
+    compare_parser.set_defaults(func=benchmark_compare)
+
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    cl_args = parse_args()
+    bptc.logger = logging.getLogger(__name__)
+    bptc.logger.addHandler(logging.NullHandler())
+    cl_args.func(cl_args)
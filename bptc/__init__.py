@@ -1,4 +1,5 @@
 import logging
+import os
 import sys
 
 # PARAMETER
@@ -6,6 +7,15 @@ C = 6  # How often a coin round occurs, e.g. 6 for every sixth round
 push_waiting_time_mu, push_waiting_time_sigma = 1, 0.02  # mean and standard deviation of push rate
 new_member_stake = 0  # the stake a new member gets
 new_member_account_balance = 10  # the initial balance of a new member
+verification_workers = os.cpu_count() or 1  # the number of threads verifying the signatures of received events
+verified_signatures_cache_size = 100000  # the number of verified signatures that are not checked again
+push_compression_level = 6  # zlib level for pushes to members who support compression, None to never compress
+max_push_frame_size = 64 * 1024 * 1024  # the maximum size of a (decompressed) push in bytes - larger ones are split
+session_idle_timeout = 60  # seconds after which an unused session to another member is closed
+reconnect_min_delay, reconnect_max_delay = 1, 120  # seconds to wait after the first/any failed connection attempt
+ingest_queue_size, ingest_queue_bytes = 100, 256 * 1024 * 1024  # received pushes waiting to be processed
+consensus_interval, consensus_batch_size = 0.5, 200  # seconds/new events after which fame and order are decided
+event_record_cache_size = 64 * 1024 * 1024  # bytes of encoded events kept for pushing them again
 
 # listening interface information
 ip = None
@@ -114,7 +114,11 @@ class ConsoleApp(InteractiveShell):
 
     def exit(self, signum=None, frame=None):
         bptc.logger.info("Stopping...")
+        self.network.close_sessions()
         network_utils.stop_reactor_thread()
+        self.network.stop_push_server_thread()
+        # The consensus must not change the events while they are saved - decide what is still pending first
+        self.network.hashgraph.flush_consensus()
         DB.save(self.network.hashgraph)
 
     # --------------------------------------------------------------------------
@@ -156,16 +160,19 @@ class ConsoleApp(InteractiveShell):
         print('Balance: {} BPTC'.format(self.me.account_balance))
         print('Stake: {}'.format(self.me.stake))
         print()
-        print('{} events, {} confirmed'.format(len(self.hashgraph.lookup_table.keys()),
-                                               len(self.hashgraph.ordered_events)))
+        snapshot = self.hashgraph.snapshot
+        print('{} events, {} confirmed'.format(snapshot.event_count, snapshot.ordered_event_count))
         print('Last push sent: {}'.format(self.network.last_push_sent))
         print('Last push received: {}'.format(self.network.last_push_received))
+        ingest_queue = self.network.background_push_server_thread.q
+        print('Pushes received: {}, merged: {}, dropped: {}'.format(ingest_queue.received, ingest_queue.merged,
+                                                                   ingest_queue.dropped))
 
     def cmd_send(self, args):
         # Stored as list if a member name contains spaces
         args.receiver = ' '.join(args.receiver or [])
         # Generate mapping from a string to members
-        members = list(self.network.hashgraph.known_members.values())
+        members = list(self.network.hashgraph.snapshot.known_members.values())
         members = [m for m in members if m != self.network.me]
         member_names = dict(itertools.chain(
             ((m.name, m) for m in members if m.name is not None and len(m.name) != 0),
@@ -204,7 +211,7 @@ class ConsoleApp(InteractiveShell):
         self.network.publish_name(' '.join(args.name))
 
     def cmd_members(self, args):
-        members = self.network.hashgraph.known_members.values()
+        members = list(self.network.hashgraph.snapshot.known_members.values())
         members = [m for m in members if m != self.network.me]
         members.sort(key=lambda x: x.formatted_name)
         members_list = '\n'.join('{}. {}'.format(i+1, repr(m)) for i, m in enumerate(members))
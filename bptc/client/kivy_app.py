@@ -63,5 +63,9 @@ class KivyApp(App):
     def on_stop(self):
         bptc.logger.info("Stopping...")
         self.network.stop_push_thread()
+        self.network.close_sessions()
         network_utils.stop_reactor_thread()
+        self.network.stop_push_server_thread()
+        # The consensus must not change the events while they are saved - decide what is still pending first
+        self.network.hashgraph.flush_consensus()
         DB.save(self.network.hashgraph)
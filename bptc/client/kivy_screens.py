@@ -63,7 +63,7 @@ class NewTransactionScreen(KivyScreen):
         super().__init__()
 
     def on_pre_enter(self, *args):
-        members = list(self.network.hashgraph.known_members.values())
+        members = list(self.network.hashgraph.snapshot.known_members.values())
         members.sort(key=lambda x: x.formatted_name)
         self.data = [{'member': m, 'is_selected': False} for m in members if m != self.network.me]
 
@@ -150,7 +150,7 @@ class MembersScreen(KivyScreen):
         super().__init__()
 
     def on_pre_enter(self, *args):
-        members = self.network.hashgraph.known_members.values()
+        members = list(self.network.hashgraph.snapshot.known_members.values())
         members = [m for m in members if m != self.network.me]
         members.sort(key=lambda x: x.formatted_name)
         # Create updated list
@@ -199,8 +199,9 @@ class DebugScreen(KivyScreen):
         # endless loop for updating information displayed
         def update_statistics():
             self.ids.listening_interface_label.text = 'Listening interface: {}:{}'.format(bptc.ip, bptc.port)
-            self.ids.event_count_label.text = '{} events, {} confirmed'.format(len(self.hashgraph.lookup_table.keys()),
-                                                                               len(self.hashgraph.ordered_events))
+            snapshot = self.hashgraph.snapshot
+            self.ids.event_count_label.text = '{} events, {} confirmed'.format(snapshot.event_count,
+                                                                               snapshot.ordered_event_count)
             self.ids.last_push_sent_label.text = 'Last push sent: {}'.format(self.network.last_push_sent)
             self.ids.last_push_received_label.text = 'Last push received: {}'.format(self.network.last_push_received)
 
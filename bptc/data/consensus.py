@@ -1,14 +1,10 @@
 import bptc
-from bptc.data.event import Event, Fame
-from bptc.data.member import Member
-from collections import defaultdict
-from typing import Set
-from datetime import datetime
+from bptc.data.event import Event, Fame, EPOCH
+from collections import Counter, defaultdict
+from typing import Dict, List, Set
+from datetime import datetime, timedelta
 import math
-import dateutil.parser
-import time
 from statistics import median
-from bptc.utils.toposort import toposort
 
 
 # DIVIDE ROUNDS
@@ -17,177 +13,201 @@ def divide_rounds(hashgraph, events):
     for event in events:
         r = 0
 
-        if event.parents.self_parent is not None:
-            r = hashgraph.lookup_table[event.parents.self_parent].round
-        if event.parents.other_parent is not None:
-            r = max(r, hashgraph.lookup_table[event.parents.other_parent].round)
+        self_parent_index, other_parent_index = event.parent_indices
+        if self_parent_index is not None:
+            r = hashgraph.events[self_parent_index].round
+        if other_parent_index is not None:
+            r = max(r, hashgraph.events[other_parent_index].round)
 
         if event_can_can_strongly_see_enough_round_r_witnesses(hashgraph, event, r):
             r = r + 1
 
         event.round = r
 
-        if event.parents.self_parent is None or event.round > hashgraph.lookup_table[event.parents.self_parent].round:
-            hashgraph.witnesses[r][event.verify_key] = event.id
+        if self_parent_index is None or event.round > hashgraph.events[self_parent_index].round:
+            hashgraph.witnesses[r][event.lane] = event.index
             event.is_witness = True
 
-        # DEBUG
-        event.processed_by_divideRounds = True
+            # A witness arriving after the fame of its round was decided can't be famous
+            if r in hashgraph.rounds_with_decided_fame:
+                event.is_famous = Fame.FALSE
+            else:
+                hashgraph.undecided_witnesses.add(event.index)
 
 
 def event_can_can_strongly_see_enough_round_r_witnesses(hashgraph, event: Event, r: int):
     members_with_strongly_seen_witnesses = get_members_with_strongly_seen_witnesses_for_round(hashgraph, event, r)
 
     # Check if all of those members have enough stake
-    strongly_seen_stake = sum([hashgraph.known_members[m].stake for m in members_with_strongly_seen_witnesses])
+    strongly_seen_stake = sum([hashgraph.members[m].stake for m in members_with_strongly_seen_witnesses])
     return strongly_seen_stake > hashgraph.supermajority_stake
 
 
-def get_members_with_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int):
-    members_on_paths = fast_get_members_on_paths_to_witnesses_for_round(hashgraph, event, r)
-    #old_members_on_paths = get_members_on_paths_to_witnesses_for_round(hashgraph, event, r)
-
-    #same = len(members_on_paths) == len(old_members_on_paths) and all([len(s) == len(o_s) for s, o_s in zip(members_on_paths, old_members_on_paths)])
-
-    #if not same:
-    #    print("Fast member on paths was not equal!")
-
-    # Collect all members who's witnesses we can strongly see
-    members_with_strongly_seen_witnesses = set()
-    for member_id, members in members_on_paths.items():
-        stake_on_path = sum([hashgraph.known_members[m].stake for m in members])
-        if stake_on_path > hashgraph.supermajority_stake:
-            members_with_strongly_seen_witnesses.add(member_id)
+def get_members_with_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int) -> Dict[int, int]:
+    """
+    Collects all members whose round r witness an event can strongly see. A member who forked may have several
+    witnesses in a round, but an event can see at most one of them - seeing two would mean seeing the fork.
+    :return: {member-index => event-index}: The strongly seen witness of each member
+    """
+    supermajority_stake = hashgraph.supermajority_stake
+    members_with_strongly_seen_witnesses = {}
+    for witness_index in hashgraph.witnesses[r].values():
+        witness = hashgraph.events[witness_index]
+        if witness.member_index in hashgraph.forks and \
+                hashgraph.get_fork_height(event, witness.member_index) <= witness.height:
+            continue
+        if event_can_strongly_see_event(hashgraph, event, witness, supermajority_stake):
+            members_with_strongly_seen_witnesses[witness.member_index] = witness_index
 
     return members_with_strongly_seen_witnesses
 
 
-def get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Event, r: int):
-    # {member_id -> set(member_id)}: For each member, the set of members through which the paths to the member's
-    #                                previous witness lead
-    result = defaultdict(set)
-
-    def visit_event(event: Event, visited_members: Set[Member]):
-        # Stop once we reach the previous round
-        if event.id != start_event.id and event.round < r:
-            return
-
-        # Add events creator to visited members
-        visited_members.add(event.verify_key)
-
-        # Check if event is witness of correct round
-        if event.verify_key in hashgraph.witnesses[r] and event.id == hashgraph.witnesses[r][event.verify_key]:
-            # We reached a witness - add the list of visited members to the result
-            result[event.verify_key] |= visited_members
-
-        # Continue searching with parents
-        # A witness might have a path to another witness of the same round, so we can't stop just because
-        # we found a witness
-        if event.parents.self_parent is not None:
-            visit_event(hashgraph.lookup_table[event.parents.self_parent], set(visited_members))
-        if event.parents.other_parent is not None:
-            visit_event(hashgraph.lookup_table[event.parents.other_parent], set(visited_members))
-
-    visit_event(start_event, set())
-
-    return result
+def event_can_strongly_see_event(hashgraph, event_1: Event, event_2: Event, supermajority_stake: int = None) -> bool:
+    """
+    Whether event 1 can strongly see event 2, i.e. whether the paths from event 1 to event 2 lead through events
+    of members owning a supermajority of stake.
+    A member is on such a path if one of its events is both a descendant of event 2 and an ancestor of event 1,
+    which can be read off the ancestry index maintained by Hashgraph.add_event. If the member forked, event 1 must
+    be able to see that event.
+    :param hashgraph:
+    :param event_1:
+    :param event_2:
+    :param supermajority_stake: The supermajority stake, if already known by the caller
+    :return:
+    """
+    if supermajority_stake is None:
+        supermajority_stake = hashgraph.supermajority_stake
+
+    last_ancestors = event_1.last_ancestors
+    first_descendants = hashgraph.get_first_descendants(event_2)
+    lanes = hashgraph.lanes
+    forks = hashgraph.forks
+    stake_on_paths = 0
+    # Members who forked have several lanes, but are only counted once
+    forked_members_on_paths = set()
+    for lane, first_descendant_height in enumerate(first_descendants[:len(last_ancestors)]):
+        if first_descendant_height < 0 or last_ancestors[lane] < first_descendant_height:
+            continue
+        member_index = lanes[lane]
+        if member_index in forks:
+            if member_index in forked_members_on_paths or \
+                    hashgraph.get_fork_height(event_1, member_index) <= first_descendant_height:
+                continue
+            forked_members_on_paths.add(member_index)
+        stake_on_paths += hashgraph.members[member_index].stake
 
+    return stake_on_paths > supermajority_stake
 
-def fast_get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Event, r: int):
-    # for every ancestor, the nodes that were visited to read it
-    members_on_paths = defaultdict(set)
-    members_on_paths[start_event.id].add(start_event.verify_key)
-    visited, queue = set(), [start_event]
 
-    while queue:
-        event = queue.pop(0)
+# DECIDE FAME
 
-        # Stop once we reach the previous round
-        if event.id != start_event.id and event.round < r:
-            continue
+def decide_fame(hashgraph):
+    """
+    Decides the fame of all witnesses which are still undecided.
+    Votes are kept until the fame of their round is decided, so every call only computes the votes of witnesses
+    that were added since the last call.
+    """
+    if len(hashgraph.undecided_witnesses) == 0:
+        return
+
+    max_round = max(hashgraph.witnesses)
+    supermajority_stake = hashgraph.supermajority_stake
+
+    rounds_with_new_decisions = set()
+    for x_index in sorted(hashgraph.undecided_witnesses, key=lambda e: hashgraph.events[e].round):
+        x = hashgraph.events[x_index]
+        decide_fame_for_witness(hashgraph, x, max_round, supermajority_stake)
+        if hashgraph.get_fame(x) != Fame.UNDECIDED:
+            hashgraph.undecided_witnesses.remove(x.index)
+            rounds_with_new_decisions.add(x.round)
+
+    # Check if rounds were completely decided
+    undecided_rounds = set(hashgraph.events[e].round for e in hashgraph.undecided_witnesses)
+    for x_round in sorted(rounds_with_new_decisions - undecided_rounds):
+        hashgraph.rounds_with_decided_fame.add(x_round)
+
+        # The votes on this round are not needed anymore
+        del hashgraph.votes[x_round]
+        bptc.logger.debug("Fame is completely decided for round {}".format(x_round))
+
+    # Witnesses only look up strongly seen witnesses to vote on undecided witnesses at least two rounds below them
+    if len(undecided_rounds) > 0:
+        lowest_undecided_round = min(undecided_rounds)
+    else:
+        lowest_undecided_round = max_round + 1
+    for y_round in [r for r in hashgraph.strongly_seen_witnesses if r < lowest_undecided_round + 2]:
+        del hashgraph.strongly_seen_witnesses[y_round]
 
-        if event not in visited:
-            visited.add(event)
-
-            if event.parents.self_parent is not None:
-                self_parent = hashgraph.lookup_table[event.parents.self_parent]
-                if self_parent.verify_key not in hashgraph.fork_blacklist:
-                    members_on_paths[self_parent.id].add(self_parent.verify_key)
-                    members_on_paths[self_parent.id].add(event.verify_key)
-                    members_on_paths[self_parent.id] |= members_on_paths[event.id]
-                    queue.append(self_parent)
-
-            if event.parents.other_parent is not None:
-                other_parent = hashgraph.lookup_table[event.parents.other_parent]
-                if other_parent.verify_key not in hashgraph.fork_blacklist:
-                    members_on_paths[other_parent.id].add(other_parent.verify_key)
-                    members_on_paths[other_parent.id].add(event.verify_key)
-                    members_on_paths[other_parent.id] |= members_on_paths[event.id]
-                    queue.append(other_parent)
-
-    # Only witnesses are relevant
-    result = defaultdict(set)
-    for member_id, witness_id in hashgraph.witnesses[r].items():
-        if len(members_on_paths[witness_id]) > 0:
-            result[member_id] = members_on_paths[witness_id]
 
-    return result
+def decide_fame_for_witness(hashgraph, x: Event, max_round: int, supermajority_stake: int) -> None:
+    """
+    Lets the witnesses of all later rounds vote on the fame of witness x, until its fame is decided
+    :param hashgraph:
+    :param x: The undecided witness
+    :param max_round: The highest round of the hashgraph
+    :param supermajority_stake: The stake needed for a supermajority
+    :return: None
+    """
+    votes = hashgraph.votes[x.round][x.index]
 
+    # The votes of a round depend on the votes of the previous round - so go through the rounds in order
+    for y_round in range(x.round+1, max_round+1):
+        for y_index in hashgraph.witnesses[y_round].values():
+            # Each witness votes once
+            if y_index in votes:
+                continue
 
-# DECIDE FAME
+            y = hashgraph.events[y_index]
+            d = y.round - x.round
+
+            if d == 1:
+                # If there is only one round difference, just vote
+                votes[y.index] = event_can_see_event(hashgraph, y, x)
+                # print('{} votes {} on {}'.format(y.short_id, votes[y.index], x.short_id))
+            else:
+                # If there are multiple rounds difference, collect votes
+                s = get_strongly_seen_witnesses_of_previous_round(hashgraph, y)
+                v, t = get_majority_vote_in_set_for_event(hashgraph, s, x)
+
+                if d % bptc.C > 0:  # This is a normal round
+                    if t > supermajority_stake:  # If supermajority, then decide
+                        hashgraph.set_fame(x, v)
+                        # print('{} fame decided: {}'.format(x.short_id, v))
+                        votes[y.index] = v
+                        return
+                    else:  # Else, just vote
+                        votes[y.index] = v
+                        # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
+                else:  # This is a coin round
+                    if t > supermajority_stake:  # If supermajority, then vote
+                        votes[y.index] = v
+                        # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
+                    else:  # Else, flip a coin
+                        # All versions flip the coin on the legacy format of the signature
+                        votes[y.index] = decide_randomly_based_on_signature(y.legacy_signature)
+                        # print('{} randomly votes {} on {}'.format(y.short_id, votes[y.index], x.short_id))
+
+
+def get_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int) -> Set[int]:
+    members_with_strongly_seen_witnesses = get_members_with_strongly_seen_witnesses_for_round(hashgraph, event, r)
+    return set(members_with_strongly_seen_witnesses.values())
 
-def decide_fame(hashgraph):
-    for x_round in range(0, max(hashgraph.witnesses)+1):
-        # Skip this round if we already decided its fame completely
-        if x_round in hashgraph.rounds_with_decided_fame:
-            continue
 
-        x_events = {e: hashgraph.lookup_table[e] for e in hashgraph.witnesses[x_round].values()}
-        for x in toposort(x_events):
-            for y_round in range(x_round+1, max(hashgraph.witnesses)+1):
-                y_events = {e: hashgraph.lookup_table[e] for e in hashgraph.witnesses[y_round].values()}
-                for y in toposort(y_events):
-                    d = y.round - x.round
-
-                    if d == 1:
-                        # If there is only one round difference, just vote
-                        y.votes[x.id] = event_can_see_event(hashgraph, y, x)
-                        # print('{} votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
-                    else:
-                        # If there are multiple rounds difference, collect votes
-                        s = get_strongly_seen_witnesses_for_round(hashgraph, y, y.round-1)
-                        v, t = get_majority_vote_in_set_for_event(hashgraph, s, x)
-
-                        if d % bptc.C > 0:  # This is a normal round
-                            if t > hashgraph.supermajority_stake:  # If supermajority, then decide
-                                x.is_famous = v
-                                # print('{} fame decided: {}'.format(x.short_id, x.is_famous))
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                                break
-                            else:  # Else, just vote
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                        else:  # This is a coin round
-                            if t > hashgraph.supermajority_stake:  # If supermajority, then vote
-                                y.votes[x.id] = v
-                                # print('{} votes {} on {}'.format(y.short_id, v, x.short_id))
-                            else:  # Else, flip a coin
-                                y.votes[x.id] = decide_randomly_based_on_signature(y.signature)
-                                # print('{} randomly votes {} on {}'.format(y.short_id, y.votes[x.id], x.short_id))
-
-        # Check if round x was completely decided
-        if all([hashgraph.lookup_table[event_id].is_famous != Fame.UNDECIDED for event_id in hashgraph.witnesses[x_round].values()]):
-            hashgraph.rounds_with_decided_fame.add(x_round)
-            bptc.logger.debug("Fame is completely decided for round {}".format(x_round))
-
-
-def get_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int) -> Set[str]:
-    members_with_strongly_seen_witnesses = get_members_with_strongly_seen_witnesses_for_round(hashgraph, event, r)
-    return set([hashgraph.witnesses[r][m] for m in members_with_strongly_seen_witnesses])
+def get_strongly_seen_witnesses_of_previous_round(hashgraph, event: Event) -> Set[int]:
+    """
+    Returns the witnesses of the previous round that a witness can strongly see. The result is cached, as it is
+    needed for each of the witness' votes.
+    :param hashgraph:
+    :param event: The witness
+    :return: The strongly seen witnesses
+    """
+    cache = hashgraph.strongly_seen_witnesses[event.round]
+    if event.index not in cache:
+        cache[event.index] = get_strongly_seen_witnesses_for_round(hashgraph, event, event.round-1)
+    return cache[event.index]
 
 
-def get_majority_vote_in_set_for_event(hashgraph, s: Set[str], x: Event) -> (bool, int):
+def get_majority_vote_in_set_for_event(hashgraph, s: Set[int], x: Event) -> (bool, int):
     """
     Returns the majority vote and the winning amount of stake that a set of witnesses has for another event
     :param hashgraph:
@@ -198,53 +218,36 @@ def get_majority_vote_in_set_for_event(hashgraph, s: Set[str], x: Event) -> (boo
 
     stake_for = 0
     stake_against = 0
+    votes = hashgraph.votes[x.round][x.index]
 
-    for event_id in s:
-        event = hashgraph.lookup_table[event_id]
-        if x.id in event.votes and event.votes[x.id]:
-            stake_for += hashgraph.known_members[event.verify_key].stake
+    for event_index in s:
+        stake = hashgraph.members[hashgraph.events[event_index].member_index].stake
+        if event_index in votes and votes[event_index]:
+            stake_for += stake
         else:
-            stake_against += hashgraph.known_members[event.verify_key].stake
+            stake_against += stake
 
     return Fame.TRUE if stake_for >= stake_against else Fame.FALSE, stake_for if stake_for >= stake_against else stake_against
 
 
 def event_can_see_event(hg, event_1: Event, event_2: Event) -> bool:
     """
-    Whether event 1 can see event 2
+    Whether event 1 can see event 2, i.e. whether event 2 is a (strict) ancestor of event 1.
+    Event 1 can't see the events of a member at or above the lowest fork of the member among its ancestors.
     :param hashgraph:
     :param event_1:
     :param event_2:
     :return:
     """
 
-    # Only calculate if the answer is not already cached
-    if event_2.id in event_1.can_see_cache:
-        return event_1.can_see_cache[event_2.id]
-    else:
-        # Check for fork
-        if event_2.verify_key in hg.fork_blacklist:
-            event_1.can_see_cache[event_2.id] = False
-            return False
-
-        if event_1.parents.self_parent == event_2.id or event_1.parents.other_parent == event_2.id:
-            event_1.can_see_cache[event_2.id] = True
-            return True
-
-        can_see = False
+    # Check for fork
+    if event_2.member_index in hg.forks and hg.get_fork_height(event_1, event_2.member_index) <= event_2.height:
+        return False
 
-        if event_1.parents.self_parent is not None:
-            can_see = event_can_see_event(hg, hg.lookup_table[event_1.parents.self_parent], event_2)
-
-        if can_see:
-            event_1.can_see_cache[event_2.id] = True
-            return True
-
-        if event_1.parents.other_parent is not None:
-            can_see = event_can_see_event(hg, hg.lookup_table[event_1.parents.other_parent], event_2)
-
-        event_1.can_see_cache[event_2.id] = can_see
-        return can_see
+    # Event 2 is an ancestor if event 1 descends from an event of the same lane which is at least as high
+    last_ancestors = event_1.last_ancestors
+    return event_1.index != event_2.index and event_2.lane < len(last_ancestors) and \
+        last_ancestors[event_2.lane] >= event_2.height
 
 
 def decide_randomly_based_on_signature(signature: str) -> bool:
@@ -256,76 +259,151 @@ def decide_randomly_based_on_signature(signature: str) -> bool:
 # FIND ORDER
 
 def find_order(hg):
-    decided_events = set()
-
-    for x_id in hg.unordered_events:
-        x = hg.lookup_table[x_id]
-        # We want to find the order of x
-        # Look for a round in which all famous witnesses see r
-        for r in range(x.round+1, max(hg.witnesses)+1):
-            # Only use rounds that have fully decided fame
-            if r not in hg.rounds_with_decided_fame:
-                continue
+    # Rounds receive their events in order, as soon as their fame is decided
+    while hg.next_round_to_receive in hg.rounds_with_decided_fame:
+        r = hg.next_round_to_receive
+
+        decided_events = get_events_received_in_round(hg, r)
+        consensus_times = get_consensus_times_for_round(hg, r, decided_events)
+        for x in decided_events:
+            hg.set_received(x, r, consensus_times[x.index].isoformat())
+            # print("Decided for {}: round_received = {}, time = {}".format(x.short_id, r, consensus_times[x.index]))
 
-            # x is an ancestor of all famous witnesses of round r
-            witnesses = [hg.lookup_table[w] for w in hg.witnesses[r].values()]
-            all_famous_witnesses_can_see_x = all([event_can_see_event(hg, w, x) or w.is_famous != Fame.TRUE for w in witnesses])
+        # Ties are broken by the hashes, as the indices differ between members
+        sorted_events = sorted(decided_events, key=lambda e: (consensus_times[e.index], e.id))
+        for e in sorted_events:
+            hg.unordered_events.remove(e.index)
+            hg.ordered_events.append(e.index)
 
-            # ("this is not true of any round earlier than r" because we count up the rounds
-            # If there was an earlier round, we would not reach this point
+        hg.next_round_to_receive += 1
+
+
+def get_events_received_in_round(hg, r: int) -> Set[Event]:
+    """
+    "set of each event x such that all famous witnesses of round r can see x" - this is not true of any earlier
+    round, because the earlier rounds already received all such events
+    :param hg: The hashgraph
+    :param r: The round whose fame was decided
+    :return: The events received in round r
+    """
+    famous_witnesses = get_unique_famous_witnesses(hg, r)
+
+    if len(famous_witnesses) > 0:
+        # The received events are ancestors of every famous witness - so we only need to look at the unordered
+        # ancestors of one of them. Ancestors of ordered events are ordered as well.
+        candidates = set()
+        to_visit = [p for p in famous_witnesses[0].parent_indices if p is not None]
+        while len(to_visit) > 0:
+            event_index = to_visit.pop()
+            if event_index in hg.unordered_events and event_index not in candidates:
+                candidates.add(event_index)
+                to_visit.extend(p for p in hg.events[event_index].parent_indices if p is not None)
+    else:
+        candidates = hg.unordered_events
+
+    result = set()
+    for x_index in candidates:
+        x = hg.events[x_index]
+        if x.round < r and all(event_can_see_event(hg, w, x) for w in famous_witnesses):
+            result.add(x)
+
+    return result
 
-            if all_famous_witnesses_can_see_x:
-                x.round_received = r
-                x.consensus_time = get_consensus_time(hg, x).isoformat()
-                x.confirmation_time = datetime.now().isoformat()
-                # print("Decided for {}: round_received = {}, time = {}".format(x.short_id, x.round_received, x.consensus_time))
-                decided_events.add(x)
 
-    sorted_events = sorted(decided_events, key=lambda e: (e.round_received, e.consensus_time, e.id))
-    for e in sorted_events:
-        e.can_see_cache.clear()
-        hg.unordered_events.remove(e.id)
-        hg.ordered_events.append(e.id)
+def get_unique_famous_witnesses(hg, r: int) -> List[Event]:
+    """
+    Returns the famous witnesses of a round, without those of members with several famous witnesses in the round
+    (which can only happen if they forked)
+    :param hg: The hashgraph
+    :param r: The round
+    :return: The unique famous witnesses
+    """
+    famous_witnesses = [hg.events[w] for w in hg.witnesses[r].values() if hg.get_fame(hg.events[w]) == Fame.TRUE]
+    creators = Counter(w.member_index for w in famous_witnesses)
+    return [w for w in famous_witnesses if creators[w.member_index] == 1]
 
 
-def get_consensus_time(hg, x) -> datetime:
-    times = [dateutil.parser.parse(e.time) for e in get_events_for_consensus_time(hg, x)]
-    timestamps = [int(time.mktime(t.timetuple())) for t in times]
-    median_timestamp = int(median(timestamps)) if timestamps else 0
-    return datetime.fromtimestamp(median_timestamp)
+def get_consensus_times_for_round(hg, r: int, events: Set[Event]) -> Dict[int, datetime]:
+    """
+    Calculates the consensus times of all events received in a round: the median of the timestamps of the events
+    used for each of them (see get_events_for_consensus_time).
+    The timestamps are compared with a precision of seconds.
+    :param hg: The hashgraph
+    :param r: The round which received the events
+    :param events: The events received in round r
+    :return: Dictionary mapping the indices of the events to their consensus time
+    """
+    timestamps = {x.index: [] for x in events}
+    for z_index, x_indices in get_events_for_consensus_time(hg, r, events).items():
+        z_timestamp = hg.events[z_index].timestamp // 1000000
+        for x_index in x_indices:
+            timestamps[x_index].append(z_timestamp)
+
+    result = {}
+    for x_index, x_timestamps in timestamps.items():
+        median_timestamp = int(median(x_timestamps)) if x_timestamps else 0
+        result[x_index] = EPOCH + timedelta(seconds=median_timestamp)
+    return result
 
 
-def get_events_for_consensus_time(hg, x) -> Set[Event]:
+def get_events_for_consensus_time(hg, r: int, events: Set[Event]) -> Dict[int, Set[int]]:
     """
+    For each event x received in round r:
     "set of each event z such that z is a self-ancestor of a round r unique famous witness,
     and x is an ancestor of z but not of the self-parent of z"
+    We walk down the self-ancestors of each famous witness once for all events. If no self-ancestor can see x, the
+    witness' first self-ancestor is used (this is not described in the paper).
     :param hg: The hashgraph
-    :param x: The event for which we want to calculate the median timestamp
-    :return:
+    :param r: The round which received the events
+    :param events: The events received in round r
+    :return: Dictionary mapping the indices of events z to the indices of the events x they are used for
     """
-    result = set()
+    result = defaultdict(set)
 
     # For all famous round r witnesses
-    r = x.round_received
-    for witness_id in hg.witnesses[r].values():
-        witness = hg.lookup_table[witness_id]
-        if witness.is_famous != Fame.TRUE:
-            continue
-
-        # Go through the self ancestors
-        z = hg.lookup_table[witness.parents.self_parent]
-        if z.parents.self_parent is not None:
-            z_self_parent = hg.lookup_table[z.parents.self_parent]
-
-            while not event_can_see_event(hg, z, x) or event_can_see_event(hg, z_self_parent, x):
-                z = hg.lookup_table[z.parents.self_parent]
-                if z.parents.self_parent is None:  # Special case for the first event - this is not described in the paper
-                    break
+    for witness in get_unique_famous_witnesses(hg, r):
+        # Go through the self ancestors - the lower they are, the fewer events x they can see
+        never_seen = []
+        unresolved = events
+        z = hg.events[witness.parent_indices[0]]
+        previous_z = None
+        while len(unresolved) > 0:
+            seen = set()
+            for x in unresolved:
+                if event_can_see_event(hg, z, x):
+                    seen.add(x)
+                elif previous_z is not None:
+                    # z is the lowest self-ancestor which can see x
+                    result[previous_z.index].add(x.index)
                 else:
-                    z_self_parent = hg.lookup_table[z.parents.self_parent]
+                    never_seen.append(x)
+            unresolved = seen
 
-            result.add(z)
-        else:  # Special case for the first event - this is not described in the paper
-            result.add(z)
+            if z.parent_indices[0] is None:
+                # Special case for the first event - this is not described in the paper
+                result[z.index].update(x.index for x in unresolved)
+                break
+            previous_z = z
+            z = hg.events[z.parent_indices[0]]
+
+        if len(never_seen) > 0:
+            first_event = get_first_self_ancestor(hg, witness)
+            result[first_event.index].update(x.index for x in never_seen)
 
     return result
+
+
+def get_first_self_ancestor(hg, event: Event) -> Event:
+    """
+    Returns the first event of the self-ancestor chain of an event
+    :param hg: The hashgraph
+    :param event: The event
+    :return: The first self-ancestor
+    """
+    # Members who forked may have several first events - so only take the shortcut for the others
+    if event.member_index in hg.first_events and event.member_index not in hg.forks:
+        return hg.events[hg.first_events[event.member_index]]
+
+    while event.parent_indices[0] is not None:
+        event = hg.events[event.parent_indices[0]]
+    return event
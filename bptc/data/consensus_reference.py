@@ -0,0 +1,267 @@
+import math
+import bptc
+from bptc.data.event import Event, Fame, EPOCH
+from bptc.data.consensus import decide_randomly_based_on_signature
+from collections import Counter, defaultdict
+from typing import Dict, List, Set
+from datetime import datetime, timedelta
+from statistics import median
+
+"""
+Straightforward implementation of the consensus, following the paper as closely as possible. It walks the
+hashgraph instead of using the ancestry index and keeps no caches between calls, so it is slow - it is the reference
+the optimized implementation in bptc.data.consensus is compared against (see benchmark.py compare).
+Forks are found in the ancestors of each event as well - it doesn't use the ancestry index or the fork evidence of
+the hashgraph. Both implementations share the consensus state of the hashgraph (witnesses, fame, order).
+"""
+
+
+# DIVIDE ROUNDS
+
+def divide_rounds(hashgraph, events):
+    for event in events:
+        r = 0
+
+        for parent_index in event.parent_indices:
+            if parent_index is not None:
+                r = max(r, hashgraph.events[parent_index].round)
+
+        strongly_seen_stake = sum(hashgraph.members[hashgraph.events[w].member_index].stake
+                                  for w in get_strongly_seen_witnesses_for_round(hashgraph, event, r))
+        if strongly_seen_stake > hashgraph.supermajority_stake:
+            r = r + 1
+
+        event.round = r
+
+        self_parent_index = event.parent_indices[0]
+        if self_parent_index is None or event.round > hashgraph.events[self_parent_index].round:
+            hashgraph.witnesses[r][event.lane] = event.index
+            event.is_witness = True
+
+            # A witness arriving after the fame of its round was decided can't be famous
+            if r in hashgraph.rounds_with_decided_fame:
+                event.is_famous = Fame.FALSE
+            else:
+                hashgraph.undecided_witnesses.add(event.index)
+
+
+def get_strongly_seen_witnesses_for_round(hashgraph, event: Event, r: int) -> Set[int]:
+    """
+    Returns the witnesses of round r that an event can strongly see, i.e. the witnesses it can see to which the paths
+    from the event lead through events it can see of members owning a supermajority of stake.
+    :param hashgraph:
+    :param event:
+    :param r:
+    :return: The indices of the strongly seen witnesses
+    """
+    ancestors = get_ancestors(hashgraph, event)
+    result = set()
+    for witness_index, members_on_paths in get_members_on_paths_to_witnesses_for_round(hashgraph, event, r,
+                                                                                         ancestors).items():
+        witness = hashgraph.events[witness_index]
+        if witness.height >= get_fork_height(hashgraph, ancestors, witness.member_index):
+            continue
+        stake_on_paths = sum(hashgraph.members[m].stake for m in members_on_paths)
+        if stake_on_paths > hashgraph.supermajority_stake:
+            result.add(witness.index)
+    return result
+
+
+def get_members_on_paths_to_witnesses_for_round(hashgraph, start_event: Event, r: int,
+                                                ancestors: Set[int]) -> Dict[int, Set[int]]:
+    """
+    Returns for each witness of round r the members through which the paths from an event to the witness lead, i.e.
+    the creators of the events which are both ancestors of the event and descendants of the witness. Only events
+    the start event can see are taken into account.
+    :param hashgraph:
+    :param start_event:
+    :param r:
+    :param ancestors: The ancestors of the start event, see get_ancestors
+    :return: {event-index -> set(member-index)}
+    """
+    # {member-index => height}: The members whose events the start event can't see from a height on
+    fork_heights = {}
+
+    # {event-index -> set(event-index)}: The round r witnesses which are ancestors of (or equal to) an event.
+    # Parents are added before their children, so they have lower indices. Descendants of a round r witness have
+    # round >= r - except for the start event, whose round isn't known yet.
+    reached_witnesses = {}
+    round_r_witnesses = set(hashgraph.witnesses[r].values())
+    result = defaultdict(set)
+    for event_index in sorted(ancestors):
+        event = hashgraph.events[event_index]
+        if event.round < r and event_index != start_event.index:
+            continue
+        reached = set()
+        for parent_index in event.parent_indices:
+            if parent_index in reached_witnesses:
+                reached |= reached_witnesses[parent_index]
+        if event.index in round_r_witnesses:
+            reached.add(event.index)
+        reached_witnesses[event_index] = reached
+
+        if event.member_index not in fork_heights:
+            fork_heights[event.member_index] = get_fork_height(hashgraph, ancestors, event.member_index)
+        if event.height < fork_heights[event.member_index]:
+            for witness_index in reached:
+                result[witness_index].add(event.member_index)
+
+    return result
+
+
+def get_ancestors(hashgraph, event: Event) -> Set[int]:
+    """
+    :return: The indices of the ancestors of an event, including the event itself
+    """
+    ancestors = {event.index}
+    to_visit = [event.index]
+    while len(to_visit) > 0:
+        for parent_index in hashgraph.events[to_visit.pop()].parent_indices:
+            if parent_index is not None and parent_index not in ancestors:
+                ancestors.add(parent_index)
+                to_visit.append(parent_index)
+    return ancestors
+
+
+def get_fork_height(hashgraph, ancestors: Set[int], member_index: int) -> float:
+    """
+    Returns the lowest height at which there are two different events of a member among the ancestors of an event -
+    the event can't see the member's events from that height on.
+    :param hashgraph:
+    :param ancestors: The ancestors of the event, see get_ancestors
+    :param member_index: The member
+    :return: The height, infinity if the member didn't fork among the ancestors
+    """
+    heights = Counter(hashgraph.events[e].height for e in ancestors if hashgraph.events[e].member_index == member_index)
+    return min([height for height, count in heights.items() if count > 1], default=math.inf)
+
+
+# DECIDE FAME
+
+def decide_fame(hashgraph):
+    """
+    Decides the fame of all witnesses which are still undecided. All votes are collected again on every call.
+    """
+    if len(hashgraph.undecided_witnesses) == 0:
+        return
+
+    max_round = max(hashgraph.witnesses)
+    for x_index in sorted(hashgraph.undecided_witnesses, key=lambda e: hashgraph.events[e].round):
+        decide_fame_for_witness(hashgraph, hashgraph.events[x_index], max_round)
+
+    for x_index in [x for x in hashgraph.undecided_witnesses if hashgraph.events[x].is_famous != Fame.UNDECIDED]:
+        hashgraph.undecided_witnesses.remove(x_index)
+
+    undecided_rounds = set(hashgraph.events[x].round for x in hashgraph.undecided_witnesses)
+    for x_round in range(0, max_round + 1):
+        if x_round not in undecided_rounds and x_round not in hashgraph.rounds_with_decided_fame:
+            hashgraph.rounds_with_decided_fame.add(x_round)
+            bptc.logger.debug("Fame is completely decided for round {}".format(x_round))
+
+
+def decide_fame_for_witness(hashgraph, x: Event, max_round: int) -> None:
+    # {event-index => bool}: The votes of the witnesses of later rounds on the fame of x
+    votes = {}
+
+    for y_round in range(x.round+1, max_round+1):
+        for y_index in hashgraph.witnesses[y_round].values():
+            y = hashgraph.events[y_index]
+            d = y.round - x.round
+
+            if d == 1:
+                # If there is only one round difference, just vote
+                votes[y.index] = event_can_see_event(hashgraph, y, x)
+            else:
+                # If there are multiple rounds difference, collect votes
+                s = get_strongly_seen_witnesses_for_round(hashgraph, y, y.round-1)
+                v, t = get_majority_vote_in_set(hashgraph, s, votes)
+
+                if d % bptc.C > 0:  # This is a normal round
+                    votes[y.index] = v
+                    if t > hashgraph.supermajority_stake:  # If supermajority, then decide
+                        x.is_famous = v
+                        return
+                else:  # This is a coin round
+                    if t > hashgraph.supermajority_stake:  # If supermajority, then vote
+                        votes[y.index] = v
+                    else:  # Else, flip a coin
+                        # All versions flip the coin on the legacy format of the signature
+                        votes[y.index] = decide_randomly_based_on_signature(y.legacy_signature)
+
+
+def get_majority_vote_in_set(hashgraph, s: Set[int], votes: Dict[int, bool]) -> (bool, int):
+    """
+    Returns the majority vote and the winning amount of stake of a set of witnesses. Missing votes count as votes
+    against.
+    """
+    stake_for = sum(hashgraph.members[hashgraph.events[e].member_index].stake for e in s if votes.get(e, False))
+    stake_against = sum(hashgraph.members[hashgraph.events[e].member_index].stake for e in s) - stake_for
+
+    if stake_for >= stake_against:
+        return Fame.TRUE, stake_for
+    return Fame.FALSE, stake_against
+
+
+def event_can_see_event(hashgraph, event_1: Event, event_2: Event) -> bool:
+    """
+    Whether event 2 is a (strict) ancestor of event 1. Event 1 can't see the events of a member at or above the
+    lowest fork of the member among its ancestors.
+    """
+    ancestors = get_ancestors(hashgraph, event_1)
+    return event_2.index != event_1.index and event_2.index in ancestors and \
+        event_2.height < get_fork_height(hashgraph, ancestors, event_2.member_index)
+
+
+# FIND ORDER
+
+def find_order(hashgraph):
+    # Rounds receive their events in order, as soon as their fame is decided
+    while hashgraph.next_round_to_receive in hashgraph.rounds_with_decided_fame:
+        r = hashgraph.next_round_to_receive
+        famous_witnesses = [hashgraph.events[w] for w in hashgraph.witnesses[r].values()
+                            if hashgraph.events[w].is_famous == Fame.TRUE]
+        # Only unique famous witnesses - members who forked may have several
+        creators = Counter(w.member_index for w in famous_witnesses)
+        famous_witnesses = [w for w in famous_witnesses if creators[w.member_index] == 1]
+
+        decided_events = [hashgraph.events[x] for x in hashgraph.unordered_events
+                          if hashgraph.events[x].round < r and
+                          all(event_can_see_event(hashgraph, w, hashgraph.events[x]) for w in famous_witnesses)]
+
+        for x in decided_events:
+            x.round_received = r
+            x.consensus_time = get_consensus_time(hashgraph, x, famous_witnesses).isoformat()
+            x.confirmation_time = datetime.now().isoformat()
+
+        for x in sorted(decided_events, key=lambda e: (e.round_received, e.consensus_time, e.id)):
+            hashgraph.unordered_events.remove(x.index)
+            hashgraph.ordered_events.append(x.index)
+
+        hashgraph.next_round_to_receive += 1
+
+
+def get_consensus_time(hashgraph, x: Event, famous_witnesses: List[Event]) -> datetime:
+    """
+    "the median of the set of timestamps of each event z such that z is a self-ancestor of a round r unique famous
+    witness, and x is an ancestor of z but not of the self-parent of z"
+    If no self-ancestor of a witness can see x, the witness' first self-ancestor is used (this is not described in
+    the paper). The timestamps are compared with a precision of seconds.
+    """
+    timestamps = []
+    for witness in famous_witnesses:
+        # The lower the self-ancestors, the fewer events they can see
+        z = None
+        self_ancestor_index = witness.parent_indices[0]
+        while self_ancestor_index is not None and \
+                event_can_see_event(hashgraph, hashgraph.events[self_ancestor_index], x):
+            z = hashgraph.events[self_ancestor_index]
+            self_ancestor_index = z.parent_indices[0]
+
+        if z is None:
+            # Special case - this is not described in the paper
+            z = witness
+            while z.parent_indices[0] is not None:
+                z = hashgraph.events[z.parent_indices[0]]
+        timestamps.append(z.timestamp // 1000000)
+
+    return EPOCH + timedelta(seconds=int(median(timestamps)) if timestamps else 0)
@@ -1,8 +1,9 @@
 import sqlite3
 import bptc
 from bptc.data.event import Event, Fame
-from bptc.data.hashgraph import Hashgraph
+from bptc.data.hashgraph import Hashgraph, filter_valid_events
 from bptc.data.member import Member
+from bptc.utils.toposort import toposort
 
 
 class DB:
@@ -131,43 +132,52 @@ class DB:
             if event.parents.other_parent is not None:
                 if event.parents.other_parent not in events:
                     raise AssertionError
-            if not event.has_valid_signature:
-                bptc.logger.warn("Event had invalid signature: {}".format(event))
-                raise AssertionError
+        if len(filter_valid_events(events)) != len(events):
+            raise AssertionError
 
         hg.lookup_table = events
 
+        # Create the internal indices and caches
+        hg.learn_members_from_events(events)
+        for event in toposort(events):
+            hg.index_event(event)
+
         # Create witness lookup
-        for event_id, event in hg.lookup_table.items():
+        for event in hg.events:
             if event.is_witness:
-                hg.witnesses[event.round][event.verify_key] = event.id
+                hg.witnesses[event.round][event.lane] = event.index
 
         # Create fame lookup
         if len(hg.witnesses) > 0:
             for x_round in range(0, max(hg.witnesses) + 1):
-                decided_witnesses_in_round_x_count = 0
-                for x_id in hg.witnesses[x_round].values():
-                    if hg.lookup_table[x_id] != Fame.UNDECIDED:
-                        decided_witnesses_in_round_x_count += 1
+                undecided_witnesses_in_round_x = set()
+                for x_index in hg.witnesses[x_round].values():
+                    if hg.events[x_index].is_famous == Fame.UNDECIDED:
+                        undecided_witnesses_in_round_x.add(x_index)
 
-                if decided_witnesses_in_round_x_count == len(hg.witnesses[x_round].items()):
+                if len(undecided_witnesses_in_round_x) == 0:
                     hg.rounds_with_decided_fame.add(x_round)
+                else:
+                    hg.undecided_witnesses |= undecided_witnesses_in_round_x
 
         # Create cache of undecided and decided events
         ordered_events = []
-        for event_id, event in hg.lookup_table.items():
+        for event in hg.events:
             if event.round_received is None:
-                hg.unordered_events.add(event_id)
+                hg.unordered_events.add(event.index)
             else:
                 ordered_events.append(event)
 
         ordered_events = sorted(ordered_events, key=lambda e: (e.round_received, e.consensus_time, e.id))
-        hg.ordered_events = [e.id for e in ordered_events]
+        hg.ordered_events = [e.index for e in ordered_events]
+        if len(ordered_events) > 0:
+            hg.next_round_to_receive = ordered_events[-1].round_received + 1
 
         bptc.logger.debug('Loaded {} events from DB.'.format(len(events)))
 
         # Create cached account balances
         hg.process_ordered_events()
+        hg.update_snapshot()
 
         return hg
 
@@ -4,10 +4,32 @@ from collections import OrderedDict
 from bptc.data.transaction import Transaction
 from typing import Dict, List, Tuple
 import json
-from libnacl import crypto_hash_sha512, crypto_sign_open, crypto_sign
+from libnacl import crypto_hash_sha512, crypto_sign_detached, crypto_sign_verify_detached, crypto_sign_BYTES
 from libnacl.encode import base64_encode, base64_decode
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# The length of a base64 encoded detached signature
+DETACHED_SIGNATURE_LENGTH = 4 * ((crypto_sign_BYTES + 2) // 3)
+
+
+def parse_time(time: str) -> int:
+    """
+    Converts a time string created with datetime.isoformat() into microseconds since the epoch
+    :param time: The time string
+    :return: The timestamp in microseconds, or 0 if the string can't be parsed
+    """
+    try:
+        if '.' in time:
+            parsed = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S.%f')
+        else:
+            parsed = datetime.datetime.strptime(time, '%Y-%m-%dT%H:%M:%S')
+    except (TypeError, ValueError):
+        return 0
+    return (parsed - EPOCH) // datetime.timedelta(microseconds=1)
+
+
 class Parents(collections.namedtuple("Parents", ["self_parent", "other_parent"])):
     """The parents of an event."""
     def __str__(self):
@@ -28,27 +50,49 @@ class Event:
     An Event is a node in the hashgraph - it may contain transactions
     """
 
+    __slots__ = ('__data', '__parents', '__time', '__verify_key', '__body', 'timestamp', '__id', 'height', 'index',
+                 'member_index', 'lane', 'parent_indices', 'round', 'signature', 'is_witness', 'is_famous',
+                 'round_received', 'consensus_time', 'last_ancestors', 'first_descendants', 'confirmation_time')
+
     def __init__(self, verify_key, data: List[Transaction], parents: Parents, time=None):
         # Immutable body of Event
-        self.data = data
-        self.parents = parents
-        self.time = datetime.datetime.now().isoformat() if time is None else time
-        self.verify_key = verify_key
+        self.__data = tuple(data) if data is not None else None
+        self.__parents = parents
+        self.__time = datetime.datetime.now().isoformat() if time is None else time
+        self.__verify_key = verify_key
         # End of immutable body
 
+        # The encoded body - it is hashed, signed and verified, so it is only created once
+        self.__body = json.dumps(OrderedDict([
+            ('data', [x.to_dict() for x in self.__data] if self.__data is not None else None),
+            ('self_parent', self.__parents.self_parent),
+            ('other_parent', self.__parents.other_parent),
+            ('time', self.__time),
+            ('verify_key', self.__verify_key)]
+        )).encode("UTF-8")
+
+        # The creation time in microseconds since the epoch
+        self.timestamp = parse_time(self.time)
+
         # Compute Event hash and ID
-        self.__id = base64_encode(crypto_hash_sha512(self.body.encode("UTF-8"))).decode("UTF-8")
+        self.__id = base64_encode(crypto_hash_sha512(self.__body)).decode("UTF-8")
 
         # Event is always created with height 0
         # The real height is determined once the event is added to the hashgraph
         self.height = 0
 
+        # The indices of the event, its creator and its parents within the hashgraph
+        # They are assigned once the event is added to the hashgraph
+        self.index = None
+        self.member_index = None
+        # The lane (branch of the member's events) of the event - see Hashgraph.lanes
+        self.lane = None
+        self.parent_indices = (None, None)
+
         # assigned round number of each event
         self.round = 0
 
-        # {event-hash => bool}
-        self.votes = dict()
-
+        # The detached signature of the body (base64) - see legacy_signature for the format of older versions
         # The signature is empty at the beginning - use sign() to sign the event once it is finished
         self.signature = None
 
@@ -62,8 +106,11 @@ class Event:
         self.round_received = None
         self.consensus_time = None
 
-        # A cache for event visibility
-        self.can_see_cache = dict()
+        # [height]: The highest event of each lane that is an ancestor of this event (incl. itself)
+        self.last_ancestors = []
+
+        # [height]: The lowest event of each lane that is a descendant of this event (incl. itself)
+        self.first_descendants = []
 
         # time when the client learns about the confirmation
         self.confirmation_time = None
@@ -76,16 +123,30 @@ class Event:
         return self.__str__()
 
     @property
-    def body(self):
+    def data(self) -> Tuple[Transaction]:
+        return self.__data
+
+    @property
+    def parents(self) -> Parents:
+        return self.__parents
+
+    @property
+    def time(self) -> str:
+        return self.__time
+
+    @property
+    def verify_key(self) -> str:
+        return self.__verify_key
+
+    @property
+    def body(self) -> str:
         """The part of an event that gets signed."""
+        return self.__body.decode("UTF-8")
 
-        return json.dumps(OrderedDict([
-            ('data', [x.to_dict() for x in self.data] if self.data is not None else None),
-            ('self_parent', self.parents.self_parent),
-            ('other_parent', self.parents.other_parent),
-            ('time', self.time),
-            ('verify_key', self.verify_key)]
-        ))
+    @property
+    def body_bytes(self) -> bytes:
+        """The encoded body, which gets hashed and signed."""
+        return self.__body
 
     @property
     def id(self):
@@ -102,7 +163,7 @@ class Event:
         event = Event(dict_event['verify_key'],
                       data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'])
         event.height = dict_event['height']
-        event.signature = dict_event['signature']
+        event.signature = detach_signature(dict_event['signature'])
         event.is_witness = dict_event['witness']
         event.is_famous = dict_event['is_famous']
         event.round_received = dict_event['round_received']
@@ -137,18 +198,21 @@ class Event:
 
         event = Event(dict_event['verify_key'],
                       data, Parents(dict_event['parents'][0], dict_event['parents'][1]), dict_event['time'])
-        event.signature = dict_event['signature']
+        event.signature = detach_signature(dict_event['signature'])
         return event
 
-    def to_dict(self) -> Dict:
-        """Save the event in a dict."""
+    def to_dict(self, detached_signature: bool = True) -> Dict:
+        """
+        Save the event in a dict.
+        :param detached_signature: Whether to use the detached signature, or the legacy format for older members
+        """
 
         return OrderedDict([
             ('data', [x.to_dict() for x in self.data] if self.data is not None else None),
             ('parents', self.parents),
             ('time', self.time),
             ('verify_key', self.verify_key),
-            ('signature', self.signature)
+            ('signature', self.signature if detached_signature else self.legacy_signature)
         ])
 
     def to_db_tuple(self) -> Tuple:
@@ -185,7 +249,7 @@ class Event:
                       e[4])
 
         event.height = e[6]
-        event.signature = e[7]
+        event.signature = detach_signature(e[7])
         event.round = e[8]
         event.is_witness = e[9]
         event.is_famous = e[10]
@@ -202,7 +266,15 @@ class Event:
         :return: None
         """
         signing_key_byte = base64_decode(signing_key.encode("UTF-8"))
-        self.signature = base64_encode(crypto_sign(self.body.encode("UTF-8"), signing_key_byte)).decode("UTF-8")
+        self.signature = base64_encode(crypto_sign_detached(self.__body, signing_key_byte)).decode("UTF-8")
+
+    @property
+    def legacy_signature(self) -> str:
+        """
+        The signature in the format of older versions, which contains the signed body as well
+        (the output of crypto_sign)
+        """
+        return base64_encode(base64_decode(self.signature.encode("UTF-8")) + self.__body).decode("UTF-8")
 
     @property
     def has_valid_signature(self) -> bool:
@@ -210,10 +282,24 @@ class Event:
         Checks whether the event has a valid signature
         :return: bool
         """
-        signature_byte = base64_decode(self.signature.encode("UTF-8"))
-        verify_key_byte = base64_decode(self.verify_key.encode("UTF-8"))
         try:
-            message = crypto_sign_open(signature_byte, verify_key_byte)
-            return message.decode('UTF-8') == self.body
+            signature_byte = base64_decode(self.signature.encode("UTF-8"))
+            verify_key_byte = base64_decode(self.verify_key.encode("UTF-8"))
+            crypto_sign_verify_detached(signature_byte, self.__body, verify_key_byte)
+            return True
         except ValueError:
             return False
+
+
+def detach_signature(signature: str) -> str:
+    """
+    Returns the detached form of a signature. Signatures in the legacy format contain the signed message after the
+    signature, which is dropped. The message is the body of the event - if it isn't, the signature isn't valid
+    for the event's body either.
+    :param signature: The signature in either format
+    :return: The detached signature
+    """
+    if signature is None or len(signature) <= DETACHED_SIGNATURE_LENGTH:
+        return signature
+    signature_byte = base64_decode(signature.encode("UTF-8"))
+    return base64_encode(signature_byte[:crypto_sign_BYTES]).decode("UTF-8")
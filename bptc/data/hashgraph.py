@@ -1,15 +1,18 @@
 import math
 import os
 import threading
-from collections import defaultdict
-from typing import Dict
-import copy
+import time
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterator, List, Optional
 from twisted.internet.address import IPv4Address
 import bptc
 from bptc.data.consensus import divide_rounds, decide_fame, find_order
-from bptc.data.event import Event, Parents
+from bptc.data.event import Event, Fame, Parents
 from bptc.data.member import Member
 from bptc.utils.toposort import toposort
+from bptc.utils.verification import verify_signatures
 from bptc.data.transaction import MoneyTransaction, TransactionStatus, PublishNameTransaction
 
 
@@ -25,33 +28,87 @@ class Hashgraph:
         self.debug_mode = debug_mode
 
         # {member-id => Member}: All members we know
-        if me is not None:
-            self.known_members = {me.id: me}
+        self.known_members = {me.id: me} if me is not None else {}
 
         # {event-hash => event}: Dictionary mapping hashes to events
         self.lookup_table = {}
 
-        # {event-hash}: Events for which the final order has not yet been determined
+        # [Event]: All events in the order they were added. Internally, events are referred to by their index in
+        # this list - the hashes are only used for communication, storage and display.
+        self.events = []
+
+        # [Member]: All members who created events. Internally, members are referred to by their index in this list.
+        self.members = []
+
+        # {member-id => member-index}: The indices of the members
+        self.member_indices = {}
+
+        # [member-index]: The creators of the lanes. A lane is a chain of events of one member, each the self-parent of
+        # the next. A member has a single lane unless it forked - each further branch of a fork starts a new lane.
+        # The ancestry index is kept per lane, so it stays exact for members who forked (see update_ancestry_index).
+        self.lanes = []
+
+        # {member-index => lane}: The lane of the first event of each member
+        self.member_lanes = {}
+
+        # {event-index}: Events for which the final order has not yet been determined
         self.unordered_events = set()
 
-        # [event-hash]: Final order of events
+        # [event-index]: Final order of events
         self.ordered_events = []
         self.next_ordered_event_idx_to_process = 0
 
-        self.idx = {}
+        # The next round which receives events once its fame is decided
+        self.next_round_to_receive = 1
 
         # {round-num}: rounds where fame is fully decided
         self.rounds_with_decided_fame = set()
 
-        # {round-num => {member-pk => event-hash}}:
+        # {event-index}: Witnesses whose fame is not yet decided
+        self.undecided_witnesses = set()
+
+        # {round-num => {event-index => {event-index => bool}}}: Votes of later witnesses on the fame of a round's
+        # witnesses. Dropped once the fame of the round is decided.
+        self.votes = defaultdict(lambda: defaultdict(dict))
+
+        # {round-num => {event-index => set(event-index)}}: Cache for the witnesses of the previous round that a
+        # round's witnesses can strongly see (used for voting)
+        self.strongly_seen_witnesses = defaultdict(dict)
+
+        # {round-num => {member-index => event-index}}:
         self.witnesses = defaultdict(dict)
 
-        # {event-hash => set(event-hash)}: Cache for event's self-children (used for fast fork check)
+        # {event-index => set(event-index)}: Cache for event's self-children (used for fast fork check)
         self.self_children_cache = defaultdict(set)
 
-        # set(member-id): A set of member who forked. Members who forked have no visible events.
+        # {member-index => event-index}: The first event of each member
+        self.first_events = {}
+
+        # {member-index => [event-index]}: The events of each member, in the order they were added. Unless the member
+        # forked, the position of an event is its height.
+        self.member_events = defaultdict(list)
+
+        # {member-index => {(lane, height) => [lane]}}: Evidence of forks - the lanes continuing with the self-children
+        # of a lane's event below a height, starting with that lane. Forks of the first event are forks of its lane at
+        # height 0. An event can't see the events of a member from the lowest fork among its ancestors on (see
+        # get_fork_height).
+        self.forks = {}
+
+        # set(member-id): A set of member who forked. We don't push to them anymore.
         self.fork_blacklist = set()
 
+        # The number of events added since fame and order were last calculated, and when that was
+        # (time.monotonic). See is_consensus_due.
+        self.events_since_consensus = 0
+        self.last_consensus_time = time.monotonic()
+
+        # The thread calculating fame and order, None if they are calculated while adding events
+        self.consensus_thread = None
+
+        # HashgraphSnapshot: Which events and members there were after the last change, for readers. Replaced after
+        # each change.
+        self.snapshot = HashgraphSnapshot(self, 0, self.known_members)
+
     @property
     def total_stake(self) -> int:
         """
@@ -68,37 +125,35 @@ class Hashgraph:
 
     def get_unknown_events_of(self, member: Member) -> Dict[str, Event]:
         """
-        Returns the presumably unknown events of a given member, in the same format as lookup_table
+        Returns the presumably unknown events of a given member, in the same format as lookup_table. Which events the
+        member knows is derived from the ancestors of its head and the heads it announced in its last push.
         :param member: The member for which to return unknown events
-        :return: Dictionary mapping hashes to events
+        :return: Dictionary mapping hashes to events, in topological order
         """
-        result = dict(self.lookup_table)
-        head = member.head
+        return self.get_current_snapshot().get_unknown_events_of(member)
 
-        if head is None:
-            return result
-
-        to_visit = {head}
-        visited = set()
-
-        while len(to_visit) > 0:
-            event_id = to_visit.pop()
-            if event_id not in visited:
-                event = result[event_id]
-                del result[event_id]
-                if event.parents.self_parent is not None:
-                    to_visit.add(event.parents.self_parent)
-                if event.parents.other_parent is not None:
-                    to_visit.add(event.parents.other_parent)
-                visited.add(event_id)
+    def get_heads(self) -> Dict[str, str]:
+        """
+        :return: The hash of the highest known event of each member, by member-id
+        """
+        return self.get_current_snapshot().get_heads()
 
-        return result
+    def get_events_above_heights(self, heights: Dict[str, int]) -> Dict[str, Event]:
+        """
+        Returns the events above given heights, e.g. the ones another member doesn't know. The cost depends on the
+        number of returned events, not on the size of the hashgraph.
+        :param heights: The height of the highest event of each member which shouldn't be returned, by member-id
+        :return: Dictionary mapping hashes to events, in topological order
+        """
+        return self.get_current_snapshot().get_events_above_heights(heights)
 
     def add_own_event(self, event: Event, calculate_consensus: bool = False):
         """
         Adds an own event to the hashgraph
         :param event: The event to be added
-        :param calculate_consensus: Whether the consensus should be calculated immediately
+        :param calculate_consensus: Whether to assign the event's round and schedule fame and order - they are decided
+            once they are due, see is_consensus_due. Not needed for the gossip event of a push, add_received_events
+            does this for all new events at once.
         :return: None
         """
 
@@ -108,12 +163,13 @@ class Hashgraph:
         # Add event
         self.add_event(event)
 
-        # Only do consensus if this is the first event
+        # Events received with a push get their rounds together with the gossip event, see add_received_events
         if calculate_consensus:
             divide_rounds(self, [event])
-            decide_fame(self)
-            find_order(self)
-            self.process_ordered_events()
+            self.events_since_consensus += 1
+            self.schedule_consensus()
+
+        self.update_snapshot()
 
     def add_event(self, event: Event):
         # Set the event's correct height
@@ -124,32 +180,264 @@ class Hashgraph:
         self.lookup_table[event.id] = event
 
         # Update caches
-        self.unordered_events.add(event.id)
+        self.index_event(event)
+        self.unordered_events.add(event.index)
         if self.known_members[event.verify_key].head is None or \
                 event.height > self.lookup_table[self.known_members[event.verify_key].head].height:
             self.known_members[event.verify_key].head = event.id
-        if event.parents.self_parent is not None:
-            self.self_children_cache[event.parents.self_parent].add(event.id)
-            if len(self.self_children_cache[event.parents.self_parent]) > 1:
+
+    def index_event(self, event: Event) -> None:
+        """
+        Assigns the internal indices of an event and its creator and updates the caches that don't depend on consensus.
+        The parents of the event must already be indexed.
+        :param event: The event that was just added
+        :return: None
+        """
+        event.index = len(self.events)
+        self.events.append(event)
+        event.member_index = self.get_member_index(event.verify_key)
+        event.parent_indices = tuple(None if parent_id is None else self.lookup_table[parent_id].index
+                                     for parent_id in event.parents)
+
+        self_parent_index = event.parent_indices[0]
+        if self_parent_index is None:
+            if event.member_index not in self.first_events:
+                self.first_events[event.member_index] = event.index
+                event.lane = self.member_lanes[event.member_index]
+            else:
+                # We just added a fork of the first event
+                first_event = self.events[self.first_events[event.member_index]]
+                event.lane = self.add_fork_evidence(event.member_index, first_event.lane, 0)
+        else:
+            self.self_children_cache[self_parent_index].add(event.index)
+            if len(self.self_children_cache[self_parent_index]) > 1:
                 # We just added a fork
-                bptc.logger.warn("A fork was created! Blacklisting member and clearing visibility caches.")
+                event.lane = self.add_fork_evidence(event.member_index, self.events[self_parent_index].lane,
+                                                    event.height)
+            else:
+                event.lane = self.events[self_parent_index].lane
+
+        self.update_ancestry_index(event)
+        self.member_events[event.member_index].append(event.index)
+
+    def get_member_index(self, member_id: str) -> int:
+        """
+        Returns the internal index of a member, assigning a new one if necessary. The member must be known.
+        :param member_id: The member's ID
+        :return: The index
+        """
+        if member_id not in self.member_indices:
+            member_index = len(self.members)
+            self.member_indices[member_id] = member_index
+            self.members.append(self.known_members[member_id])
+            self.member_lanes[member_index] = len(self.lanes)
+            self.lanes.append(member_index)
+        return self.member_indices[member_id]
+
+    def add_fork_evidence(self, member_index: int, lane: int, height: int) -> int:
+        """
+        Records that an event of a member is a fork: another event of the lane already continues at its height.
+        Blacklists the member and starts a new lane for the event.
+        Which events can see which others only depends on their ancestors, so nothing that was calculated before
+        becomes invalid.
+        :param member_index: The member who forked
+        :param lane: The lane of the event's self-parent, or the lane of the member's first event for a fork of it
+        :param height: The height of the event
+        :return: The lane of the event
+        """
+        bptc.logger.warn("A fork was created! Blacklisting member.")
+        self.fork_blacklist.add(self.members[member_index].id)
+
+        new_lane = len(self.lanes)
+        self.lanes.append(member_index)
+        self.forks.setdefault(member_index, {}).setdefault((lane, height), [lane]).append(new_lane)
+        return new_lane
+
+    def get_fork_height(self, event: Event, member_index: int) -> float:
+        """
+        Returns the height of the lowest fork of a member among the ancestors of an event (including itself) - the
+        event can't see the member's events from that height on. There is such a fork if the event descends from
+        at least two of the lanes continuing at a fork.
+        :param event: The event
+        :param member_index: The member
+        :return: The height, infinity if the event doesn't descend from a fork of the member
+        """
+        result = math.inf
+        if member_index in self.forks:
+            last_ancestors = event.last_ancestors
+            for (_, height), lanes in self.forks[member_index].items():
+                if height < result and \
+                        sum(1 for lane in lanes if lane < len(last_ancestors) and last_ancestors[lane] >= height) > 1:
+                    result = height
+        return result
+
+    def get_first_descendants(self, event: Event) -> List[int]:
+        """
+        :return: The height of the first descendant of an event in each lane, see update_ancestry_index
+        """
+        return event.first_descendants
+
+    def get_fame(self, event: Event) -> int:
+        """
+        :return: The fame of a witness, see ConsensusView.get_fame
+        """
+        return event.is_famous
 
-                # Blacklist the member who forked
-                self.fork_blacklist.add(event.verify_key)
+    def set_fame(self, event: Event, fame: int) -> None:
+        """Decides the fame of a witness."""
+        event.is_famous = fame
 
-                # Visibility for events could have changed - throw away the caches
-                for e in self.lookup_table.values():
-                    e.can_see_cache.clear()
+    def set_received(self, event: Event, round_received: int, consensus_time: str) -> None:
+        """Decides the round received and the consensus time of an event."""
+        event.round_received = round_received
+        event.consensus_time = consensus_time
+        event.confirmation_time = datetime.now().isoformat()
+
+    def update_ancestry_index(self, event: Event) -> None:
+        """
+        Updates the last ancestors of a newly added event and the first descendants of all its ancestors.
+        Both are used to answer "see" and "strongly see" queries without walking the graph.
+        Both are lists of heights indexed by lane, where -1 stands for no such event. As each lane is a chain, an
+        event descends from the event of a lane at a height if its last ancestor in the lane is at least as high.
+        :param event: The event that was just added
+        :return: None
+        """
+        # The last ancestors of an event are the element-wise maximum of those of its parents
+        parents = [self.events[p] for p in event.parent_indices if p is not None]
+        if len(parents) == 0:
+            last_ancestors = []
+        elif len(parents) == 1:
+            last_ancestors = list(parents[0].last_ancestors)
+        else:
+            longer, shorter = sorted((parents[0].last_ancestors, parents[1].last_ancestors), key=len, reverse=True)
+            last_ancestors = list(map(max, longer[:len(shorter)], shorter)) + longer[len(shorter):]
+        if len(last_ancestors) <= event.lane:
+            last_ancestors.extend([-1] * (event.lane + 1 - len(last_ancestors)))
+        last_ancestors[event.lane] = event.height
+        event.last_ancestors = last_ancestors
+
+        # The event is the first descendant in its lane of all ancestors that don't have one yet.
+        # We can stop at ancestors which already have one - so do their own ancestors.
+        lane = event.lane
+        to_visit = [event]
+        while len(to_visit) > 0:
+            ancestor = to_visit.pop()
+            first_descendants = ancestor.first_descendants
+            if len(first_descendants) <= lane:
+                first_descendants.extend([-1] * (lane + 1 - len(first_descendants)))
+            if first_descendants[lane] < 0:
+                first_descendants[lane] = event.height
+                to_visit.extend(self.events[p] for p in ancestor.parent_indices if p is not None)
 
     def process_events(self, from_member: Member, events: Dict[str, Event]) -> None:
         """
-        Processes a list of events
+        Processes a list of events. The hashgraph takes ownership of the new events, so they must not be shared.
         :param from_member: The member from whom the events were received
         :param events: The events to be processed
         :return: None
         """
-        events = copy.deepcopy(events)
-        bptc.logger.debug("Processing {} events from {}...".format(len(events), from_member.verify_key[:6]))
+        try:
+            self.add_received_events(from_member, events)
+        finally:
+            self.update_snapshot()
+
+        # Debug mode writes the DB to a file every 100 events.
+        if self.debug_mode:
+            number_events = (len(self.lookup_table) // 100) * 100
+            # Don't store when there are not enough events or it would overwrite
+            # the last temporary db
+            if number_events > 0 and number_events > self.debug_mode:
+                bptc.logger.debug('Store intermediate results containing about {} events'.format(number_events))
+                from bptc.data.db import DB
+                DB.save(self, temp=True)
+                self.debug_mode = (len(self.lookup_table) // 100) * 100
+
+    def update_snapshot(self) -> None:
+        """Publishes the current state to the readers. Needs the lock."""
+        self.snapshot = HashgraphSnapshot(self, self.snapshot.version + 1, self.known_members)
+
+    def get_current_snapshot(self) -> "HashgraphSnapshot":
+        """
+        :return: The snapshot of the current state - it is published if it changed since the last snapshot
+        """
+        with self.lock:
+            if self.snapshot.event_count != len(self.events) or \
+                    self.snapshot.ordered_event_count != len(self.ordered_events) or \
+                    len(self.snapshot.known_members) != len(self.known_members):
+                self.update_snapshot()
+            return self.snapshot
+
+    def is_consensus_due(self, force: bool = False) -> bool:
+        """
+        Whether fame and order should be calculated - if bptc.consensus_batch_size events were added since this was
+        done last, or bptc.consensus_interval seconds passed and events were added. Calculating them less often saves
+        CPU time, but events are ordered later.
+        :param force: Whether they are due if any events were added
+        :return: Whether they are due
+        """
+        if self.events_since_consensus == 0:
+            return False
+        return force or self.events_since_consensus >= bptc.consensus_batch_size or \
+            time.monotonic() - self.last_consensus_time >= bptc.consensus_interval
+
+    def schedule_consensus(self) -> None:
+        """
+        Tells the consensus thread that events were added - or calculates the consensus if there is none and it is
+        due. Without the thread, fame and order of the last events are only decided when more events are added, so
+        use flush_consensus once no more events are added.
+        """
+        if self.consensus_thread is not None:
+            self.consensus_thread.wake()
+        else:
+            self.calculate_consensus()
+
+    def calculate_consensus(self, force: bool = False) -> bool:
+        """
+        Decides fame and order if they are due, and processes the newly ordered events. Must not be used while a
+        consensus thread runs for this hashgraph.
+        :param force: Whether to calculate them if any events were added
+        :return: Whether they were calculated
+        """
+        with self.lock:
+            if not self.is_consensus_due(force):
+                return False
+            view = ConsensusView(self)
+            decide_fame(view)
+            find_order(view)
+            view.publish()
+            return True
+
+    def start_consensus_thread(self) -> None:
+        """Starts calculating fame and order in a separate thread, without holding the lock most of the time."""
+        self.consensus_thread = ConsensusThread(self)
+        self.consensus_thread.daemon = True
+        self.consensus_thread.start()
+
+    def stop_consensus_thread(self) -> None:
+        """
+        Stops the consensus thread and waits until it finished, e.g. before the hashgraph is saved. Must not be called
+        while holding the lock, as the thread may need it to publish its last calculation.
+        """
+        if self.consensus_thread is not None:
+            self.consensus_thread.stop()
+            self.consensus_thread.join()
+            self.consensus_thread = None
+
+    def flush_consensus(self) -> bool:
+        """
+        Decides fame and order of the events added since they were calculated last, even if they aren't due yet - e.g.
+        before the hashgraph is saved. Stops the consensus thread first, so it must not be called while holding the
+        lock either.
+        :return: Whether they were calculated
+        """
+        self.stop_consensus_thread()
+        return self.calculate_consensus(force=True)
+
+    def add_received_events(self, from_member: Member, events: Dict[str, Event]) -> None:
+        """Adds received events and a gossip event for them, see process_events."""
+        # Drop the events we already know before doing any work on them
+        events = {event_id: event for event_id, event in events.items() if event_id not in self.lookup_table}
+        bptc.logger.debug("Processing {} new events from {}...".format(len(events), from_member.verify_key[:6]))
 
         # Only deal with valid events
         events = filter_valid_events(events)
@@ -179,22 +467,10 @@ class Hashgraph:
         self.add_own_event(event)
         new_events[event.id] = event
 
-        # Figure out fame, order, etc.
+        # Rounds are assigned immediately, fame and order once enough events or time have passed
         divide_rounds(self, toposort(new_events))
-        decide_fame(self)
-        find_order(self)
-        self.process_ordered_events()
-
-        # Debug mode writes the DB to a file every 100 events.
-        if self.debug_mode:
-            number_events = (len(self.lookup_table) // 100) * 100
-            # Don't store when there are not enough events or it would overwrite
-            # the last temporary db
-            if number_events > 0 and number_events > self.debug_mode:
-                bptc.logger.debug('Store intermediate results containing about {} events'.format(number_events))
-                from bptc.data.db import DB
-                DB.save(self, temp=True)
-                self.debug_mode = (len(self.lookup_table) // 100) * 100
+        self.events_since_consensus += len(new_events)
+        self.schedule_consensus()
 
     def learn_members_from_events(self, events: Dict[str, Event]) -> None:
         """
@@ -207,8 +483,8 @@ class Hashgraph:
                 self.known_members[event.verify_key] = Member(event.verify_key, None)
 
     def process_ordered_events(self):
-        for event_id in self.ordered_events[self.next_ordered_event_idx_to_process:len(self.ordered_events)]:
-            event = self.lookup_table[event_id]
+        for event_index in self.ordered_events[self.next_ordered_event_idx_to_process:len(self.ordered_events)]:
+            event = self.events[event_index]
             if event.data is None:
                 continue
 
@@ -264,8 +540,7 @@ class Hashgraph:
     def get_relevant_transactions(self, plain=False, show_all=False):
         # Load transactions belonging to this member
         transactions = []
-        events = list(self.lookup_table.values())
-        for e in events:
+        for e in self.snapshot.events:
             for t in e.data or []:
                 if isinstance(t, MoneyTransaction):
                     if show_all or self.me.to_verifykey_string() in [e.verify_key, t.receiver]:
@@ -273,15 +548,276 @@ class Hashgraph:
         return sorted(transactions, key=lambda x: x['time'], reverse=True)
 
 
+class HashgraphSnapshot:
+    """
+    Which events and members a hashgraph had at one point, for readers which shouldn't block or be blocked by the
+    writers (pushes, the pull server, the UI). The hashgraph replaces its snapshot after each change, so getting the
+    current one neither takes the lock nor copies the events.
+    Events, ordered events and the events of each member are only ever appended, so a snapshot shares these lists
+    with the hashgraph and remembers how long they were. The small parts which change in place (known members,
+    fork heights) are copied.
+    A snapshot is not a frozen copy: the members and events themselves are shared, so their consensus attributes,
+    heads and account balances are the current ones, which may be newer than the snapshot.
+    """
+
+    def __init__(self, hashgraph: Hashgraph, version: int, known_members: Dict[str, Member]):
+        # Increases with every change of the hashgraph
+        self.version = version
+        self.me = hashgraph.me
+
+        self.__events = hashgraph.events
+        self.event_count = len(hashgraph.events)
+        self.__ordered_events = hashgraph.ordered_events
+        self.ordered_event_count = len(hashgraph.ordered_events)
+        self.__lookup_table = hashgraph.lookup_table
+
+        self.__members = hashgraph.members
+        self.__member_indices = hashgraph.member_indices
+        self.__lanes = hashgraph.lanes
+        # {member-index => ([event-index], number of events)}
+        self.__member_events = {member_index: (event_indices, len(event_indices))
+                                for member_index, event_indices in hashgraph.member_events.items()}
+        # {member-index => height}: The height of the lowest fork of each member who forked
+        self.lowest_fork_heights = {member_index: min(height for _, height in forks)
+                                    for member_index, forks in hashgraph.forks.items()}
+
+        # {member-id => Member}: All members we knew
+        self.known_members = dict(known_members)
+
+    @property
+    def events(self) -> Iterator[Event]:
+        """All events, in the order they were added"""
+        return islice(self.__events, self.event_count)
+
+    @property
+    def ordered_events(self) -> Iterator[Event]:
+        """The events in their final order"""
+        return (self.__events[e] for e in islice(self.__ordered_events, self.ordered_event_count))
+
+    def get_event(self, event_id: str) -> Optional[Event]:
+        """
+        :return: The event with the given hash - None if it wasn't known yet
+        """
+        event = self.__lookup_table.get(event_id)
+        if event is None or event.index is None or event.index >= self.event_count:
+            return None
+        return event
+
+    def get_unknown_events_of(self, member: Member) -> Dict[str, Event]:
+        """See Hashgraph.get_unknown_events_of - only events of the snapshot are returned."""
+        heights = {}
+
+        head = self.get_event(member.head) if member.head is not None else None
+        if head is None and member.id in self.__member_indices:
+            # The head may be newer than the snapshot - the member knows all ancestors of its events before it
+            head_index = self.__get_head_index(self.__member_indices[member.id])
+            head = self.__events[head_index] if head_index is not None else None
+        if head is not None:
+            # The member knows all ancestors of its own head
+            for lane, height in enumerate(head.last_ancestors):
+                member_id = self.__members[self.__lanes[lane]].id
+                heights[member_id] = max(heights.get(member_id, -1), height)
+
+        if member.announced_heads is not None:
+            # The member knows all self-ancestors of the heads it announced. We can only tell their heights if we
+            # know them as well - otherwise the member is ahead of us, or knows another branch of a fork.
+            for member_id, event_id in member.announced_heads.items():
+                event = self.get_event(event_id)
+                if event is not None:
+                    heights[member_id] = max(heights.get(member_id, -1), event.height)
+
+        return self.get_events_above_heights(heights)
+
+    def get_heads(self) -> Dict[str, str]:
+        """See Hashgraph.get_heads"""
+        heads = {}
+        for member_index in self.__member_events:
+            head_index = self.__get_head_index(member_index)
+            if head_index is not None:
+                heads[self.__members[member_index].id] = self.__events[head_index].id
+        return heads
+
+    def __get_head_index(self, member_index: int) -> Optional[int]:
+        """
+        :return: The index of the highest event of a member in the snapshot - None if there is none
+        """
+        event_indices, count = self.__member_events.get(member_index, ([], 0))
+        if count == 0:
+            return None
+        if member_index in self.lowest_fork_heights:
+            return max(event_indices[:count], key=lambda e: self.__events[e].height)
+        return event_indices[count - 1]
+
+    def get_events_above_heights(self, heights: Dict[str, int]) -> Dict[str, Event]:
+        """See Hashgraph.get_events_above_heights"""
+        result = []
+        for member_index, (event_indices, count) in self.__member_events.items():
+            height = heights.get(self.__members[member_index].id, -1)
+            if member_index in self.lowest_fork_heights:
+                # Another member may know a different branch of the fork - so send all of them
+                height = min(height, self.lowest_fork_heights[member_index] - 1)
+                result.extend(e for e in event_indices[:count] if self.__events[e].height > height)
+            else:
+                result.extend(event_indices[height + 1:count])
+
+        # Events are added in topological order
+        return OrderedDict((self.__events[e].id, self.__events[e]) for e in sorted(result))
+
+
+class ConsensusView:
+    """
+    The state of a hashgraph that fame and order are calculated on, copied while the hashgraph is locked. The
+    consensus functions work on it like on the hashgraph, while events are added to the hashgraph.
+    Events, members and lanes are only ever appended, so the view shares them with the hashgraph - the consensus
+    only looks at events that existed when the view was created, as their ancestors existed as well. The first
+    descendants of an event and the forks do change when events are added, so those of the witnesses and the forks
+    are copied. Votes and strongly seen witnesses only depend on the ancestors of the events they are about, and are
+    only written by whoever calculates the consensus, so they are shared too.
+    The decisions are collected in the view instead of being written to the shared events, and published to the
+    events and the hashgraph at once (see publish), so readers holding the lock never see half of a calculation.
+    """
+
+    def __init__(self, hashgraph: Hashgraph):
+        self.hashgraph = hashgraph
+        self.events = hashgraph.events
+        self.members = hashgraph.members
+        self.votes = hashgraph.votes
+        self.strongly_seen_witnesses = hashgraph.strongly_seen_witnesses
+        self.supermajority_stake = hashgraph.supermajority_stake
+
+        self.initial_undecided_witnesses = set(hashgraph.undecided_witnesses)
+        self.undecided_witnesses = set(hashgraph.undecided_witnesses)
+        self.rounds_with_decided_fame = set(hashgraph.rounds_with_decided_fame)
+        self.unordered_events = set(hashgraph.unordered_events)
+        self.next_round_to_receive = hashgraph.next_round_to_receive
+        self.first_events = dict(hashgraph.first_events)
+        self.lanes = hashgraph.lanes
+        self.forks = {member_index: {fork: list(lanes) for fork, lanes in forks.items()}
+                      for member_index, forks in hashgraph.forks.items()}
+
+        # [event-index]: The events ordered by this calculation
+        self.ordered_events = []
+
+        # {event-index => fame}: The fame decided by this calculation
+        self.fame = {}
+
+        # {event-index => (round received, consensus time, confirmation time)}: The order decided by this calculation
+        self.received = {}
+
+        # Only the rounds that aren't decided or ordered yet are needed
+        lowest_round = min([self.next_round_to_receive] +
+                           [self.events[w].round for w in self.undecided_witnesses])
+        self.witnesses = defaultdict(dict, {r: dict(witnesses) for r, witnesses in hashgraph.witnesses.items()
+                                            if r >= lowest_round})
+
+        # {event-index => [height]}: The first descendants of these witnesses, the only ones that are looked up
+        self.first_descendants = {w: list(self.events[w].first_descendants)
+                                  for witnesses in self.witnesses.values() for w in witnesses.values()}
+
+        hashgraph.events_since_consensus = 0
+        hashgraph.last_consensus_time = time.monotonic()
+
+    get_fork_height = Hashgraph.get_fork_height
+
+    def get_first_descendants(self, event: Event) -> List[int]:
+        return self.first_descendants[event.index]
+
+    def get_fame(self, event: Event) -> int:
+        """
+        :return: The fame of a witness, including the decisions of this calculation
+        """
+        return self.fame.get(event.index, event.is_famous)
+
+    def set_fame(self, event: Event, fame: int) -> None:
+        self.fame[event.index] = fame
+
+    def set_received(self, event: Event, round_received: int, consensus_time: str) -> None:
+        self.received[event.index] = (round_received, consensus_time, datetime.now().isoformat())
+
+    def publish(self) -> None:
+        """
+        Publishes the decisions to the events and the hashgraph and processes the newly ordered events. Needs the lock.
+        """
+        hg = self.hashgraph
+        for event_index, fame in self.fame.items():
+            self.events[event_index].is_famous = fame
+        for event_index, (round_received, consensus_time, confirmation_time) in self.received.items():
+            event = self.events[event_index]
+            event.round_received = round_received
+            event.consensus_time = consensus_time
+            event.confirmation_time = confirmation_time
+
+        hg.undecided_witnesses -= self.initial_undecided_witnesses - self.undecided_witnesses
+
+        newly_decided_rounds = self.rounds_with_decided_fame - hg.rounds_with_decided_fame
+        hg.rounds_with_decided_fame |= newly_decided_rounds
+
+        # Witnesses which were added in the meantime can't be famous if the fame of their round was decided
+        for w in [w for w in hg.undecided_witnesses if hg.events[w].round in newly_decided_rounds]:
+            hg.events[w].is_famous = Fame.FALSE
+            hg.undecided_witnesses.remove(w)
+
+        hg.unordered_events.difference_update(self.ordered_events)
+        hg.ordered_events.extend(self.ordered_events)
+        hg.next_round_to_receive = self.next_round_to_receive
+        hg.process_ordered_events()
+        hg.update_snapshot()
+
+
+class ConsensusThread(threading.Thread):
+    """
+    Calculates fame and order of a hashgraph whenever they are due. The lock of the hashgraph is only held while its
+    state is copied and while the results are published, so events can be added and read in the meantime.
+    """
+
+    def __init__(self, hashgraph: Hashgraph):
+        super(ConsensusThread, self).__init__()
+        self.hashgraph = hashgraph
+        self._wake_event = threading.Event()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self.stopped():
+            # Fame and order may become due when events are added, or when the interval passed
+            self._wake_event.wait(bptc.consensus_interval or None)
+            self._wake_event.clear()
+
+            with self.hashgraph.lock:
+                if self.stopped() or not self.hashgraph.is_consensus_due():
+                    continue
+                view = ConsensusView(self.hashgraph)
+
+            try:
+                decide_fame(view)
+                find_order(view)
+
+                with self.hashgraph.lock:
+                    view.publish()
+            except Exception:
+                # The decisions of this calculation aren't published, the next calculation makes them again
+                bptc.logger.exception('Calculating the consensus failed')
+
+    def wake(self):
+        self._wake_event.set()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+
 def filter_valid_events(events: Dict[str, Event]) -> Dict[str, Event]:
     """
-    Goes through a dict of events and returns a dict containing only the valid ones
+    Goes through a dict of events and returns a dict containing only the valid ones.
+    The signatures are verified in parallel, see bptc.utils.verification.
     :param events: The dict to be filtered
     :return: A dict containing only valid events
     """
     result = dict()
-    for event_id, event in events.items():
-        if event.has_valid_signature:
+    for (event_id, event), valid in zip(events.items(), verify_signatures(events.values())):
+        if valid:
             result[event_id] = event
         else:
             bptc.logger.warn("Event had invalid signature: {}".format(event))
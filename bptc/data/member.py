@@ -11,6 +11,9 @@ class Member:
     A Member is a participant in the Hashgraph
     """
 
+    __slots__ = ('signing_key', 'verify_key', 'head', 'stake', '__address', 'name', 'account_balance',
+                 'protocol_version', 'announced_heads')
+
     def __init__(self, verify_key, signing_key):
         # The key used to sign data
         self.signing_key = signing_key
@@ -41,9 +44,13 @@ class Member:
         # The account balance of this member
         self.account_balance = bptc.new_member_account_balance
 
-        # How often pushing to this member has failed
-        # Is reset when the Address changes
-        self.push_fail_count = 0
+        # The version of the push protocol the member announced in its last push
+        # Members we haven't heard from are assumed to use the first version
+        self.protocol_version = 1
+
+        # {member-id => event-hash}: The highest known event of each member, as announced by the member in its last
+        # push - or None
+        self.announced_heads = None
 
     @property
     def address(self):
@@ -52,7 +59,6 @@ class Member:
     @address.setter
     def address(self, new_address):
         self.__address = new_address
-        self.push_fail_count = 0
 
     @classmethod
     def create(cls) -> 'Member':
@@ -1,13 +1,13 @@
-import queue
+from collections import defaultdict, deque, OrderedDict
 from random import choice
 from typing import Dict, List
 import random
-import json
 from bptc.data.event import Event, Parents
 from bptc.data.hashgraph import Hashgraph
 from bptc.data.transaction import MoneyTransaction, PublishNameTransaction
 from bptc.data.db import DB
-from bptc.protocols.push_protocol import PushClientFactory
+from bptc.protocols.codec import BinaryCodec, CachedBinaryCodec, JSONCodec, decode_message
+from bptc.protocols.push_protocol import PushClientFactory, PushSessionFactory
 import time
 from datetime import datetime
 import threading
@@ -20,6 +20,26 @@ from bptc.protocols.push_protocol import PushServerFactory
 from bptc.protocols.pull_protocol import PullServerFactory
 
 
+# The version of the push protocol. Pushes announce the version of the sender, and are encoded in the version of
+# the receiver. Versions:
+# 1: Signatures contain the signed event body (crypto_sign)
+# 2: Detached signatures
+# 3: Binary codec (see bptc.protocols.codec)
+# 4: Compressed pushes (see bptc.protocols.push_protocol)
+# 5: Framed pushes
+# 6: Sessions - long-lived connections carrying the pushes of both members
+# 7: Binary codec with cached event encodings
+# The version only covers the push protocol, not the consensus rules - members running versions with different
+# consensus rules can't be told apart, so all members of a network have to upgrade together (see README.md).
+PROTOCOL_VERSION = 7
+DETACHED_SIGNATURES_VERSION = 2
+BINARY_CODEC_VERSION = 3
+COMPRESSION_VERSION = 4
+FRAMING_VERSION = 5
+SESSION_VERSION = 6
+CACHED_BINARY_CODEC_VERSION = 7
+
+
 class Network:
 
     """Provides the functionality needed for a member to interact with other members"""
@@ -31,6 +51,9 @@ class Network:
         # the thread that frequently pushes
         self.background_push_client_thread = None
 
+        # the connections to other members
+        self.connection_pool = ConnectionPool(self)
+
         # the thread that processes the pushes from other members
         self.background_push_server_thread = PushingServerThread(self)
         self.background_push_server_thread.daemon = True
@@ -40,6 +63,9 @@ class Network:
         self.last_push_sent = None
         self.last_push_received = None
 
+        # Calculate fame and order without blocking the hashgraph
+        self.hashgraph.start_consensus_thread()
+
         # Create first own event
         if create_initial_event:
             self.hashgraph.add_own_event(Event(self.hashgraph.me.verify_key, None, Parents(None, None)), True)
@@ -55,20 +81,29 @@ class Network:
         new_me = Member.create()
         new_me.address = IPv4Address("TCP", bptc.ip, bptc.port)
         new_hashgraph = Hashgraph(new_me)
+        # The sessions belong to the old member
+        self.close_sessions()
+        self.hashgraph.stop_consensus_thread()
         self.hashgraph = new_hashgraph
+        self.hashgraph.start_consensus_thread()
         self.hashgraph.add_own_event(Event(self.hashgraph.me.verify_key, None, Parents(None, None)), True)
         self.last_push_sent = None
         self.last_push_received = None
 
+    def close_sessions(self) -> None:
+        """Closes the sessions to other members, e.g. before stopping. Can be called from any thread."""
+        reactor.callFromThread(self.connection_pool.close)
+
     def push_to(self, ip, port) -> None:
         """Push to the specified network address."""
 
-        with self.hashgraph.lock:
-            data_string = self.generate_data_string(self.hashgraph.me,
-                                                    self.hashgraph.lookup_table,
-                                                    filter_members_with_address(self.hashgraph.known_members.values()))
+        snapshot = self.hashgraph.snapshot
+        data_strings = self.generate_data_strings(snapshot.me,
+                                                  snapshot.get_events_above_heights({}),
+                                                  filter_members_with_address(snapshot.known_members.values()),
+                                                  heads=snapshot.get_heads())
 
-        factory = PushClientFactory(data_string, network=self)
+        factory = PushClientFactory(data_strings, network=self)
 
         def push():
             reactor.connectTCP(ip, port, factory)
@@ -76,62 +111,81 @@ class Network:
         threads.blockingCallFromThread(reactor, push)
 
     @staticmethod
-    def generate_data_string(me, events, members):
-        """Generates a string out of events and members for transferring it over the network."""
-
-        serialized_events = {}
-        if events is not None:
-            for event_id, event in events.items():
-                serialized_events[event_id] = event.to_dict()
-
-        serialized_members = []
-        if members is not None:
-            for member in members:
-                if member.id is not me.verify_key:
-                    serialized_members.append(member.to_dict())
+    def generate_data_string(me, events, members, protocol_version=1, heads=None):
+        """
+        Generates a string out of events and members for transferring it over the network.
+        The data is encoded in the given version of the push protocol - the one of the receiver.
+        The highest known events of each member (heads) tell the receiver which events to push back.
+        """
 
         data_to_send = {
             'from': {
                 'verify_key': me.verify_key,
-                'listening_port': me.address.port
+                'listening_port': me.address.port,
+                'protocol_version': PROTOCOL_VERSION,
+                'heads': heads
             },
-            'events': serialized_events,
-            'members': serialized_members
+            'events': events if events is not None else {},
+            'members': [member for member in members if member.id is not me.verify_key] if members is not None else []
         }
 
-        return json.dumps(data_to_send).encode('UTF-8')
+        if protocol_version >= CACHED_BINARY_CODEC_VERSION:
+            encoder = CachedBinaryCodec()
+        elif protocol_version >= BINARY_CODEC_VERSION:
+            encoder = BinaryCodec()
+        else:
+            encoder = JSONCodec(detached_signatures=protocol_version >= DETACHED_SIGNATURES_VERSION)
+        return encoder.encode(data_to_send)
+
+    @classmethod
+    def generate_data_strings(cls, me, events, members, protocol_version=1, heads=None) -> List[bytes]:
+        """
+        Generates the data strings of a push, see generate_data_string. Receivers reject data strings larger than
+        bptc.max_push_frame_size, so larger pushes are split into several, each containing a part of the events.
+        The events are in topological order, so the parents of an event are in the same or an earlier part.
+        :return: The data strings, to be sent in this order
+        """
+        data_string = cls.generate_data_string(me, events, members, protocol_version, heads)
+        if len(data_string) <= bptc.max_push_frame_size or events is None or len(events) <= 1:
+            return [data_string]
+
+        items = list(events.items())
+        number_of_parts = min(len(items), len(data_string) // bptc.max_push_frame_size + 1)
+        part_size = -(-len(items) // number_of_parts)
+        data_strings = []
+        for i in range(0, len(items), part_size):
+            # The members are only sent once
+            data_strings += cls.generate_data_strings(me, OrderedDict(items[i:i + part_size]),
+                                                      members if i == 0 else None, protocol_version, heads)
+        return data_strings
 
     def push_to_member(self, member: Member, ignore_for_statistics=False) -> None:
         """Push to the specified member."""
 
         bptc.logger.debug('Push to {}... ({}, {})'.format(member.verify_key[:6], member.address.host, member.address.port))
 
-        with self.hashgraph.lock:
-            data_string = self.generate_data_string(self.hashgraph.me,
-                                                    self.hashgraph.get_unknown_events_of(member),
-                                                    filter_members_with_address(self.hashgraph.known_members.values()))
-
-        if not ignore_for_statistics:
-            factory = PushClientFactory(data_string, network=self, receiver=member)
-        else:
-            factory = PushClientFactory(data_string, network=None, receiver=member)
+        # Serializing doesn't block the hashgraph
+        snapshot = self.hashgraph.snapshot
+        data_strings = self.generate_data_strings(snapshot.me,
+                                                  snapshot.get_unknown_events_of(member),
+                                                  filter_members_with_address(snapshot.known_members.values()),
+                                                  member.protocol_version,
+                                                  snapshot.get_heads())
 
-        def push():
-            if member.address is not None:
-                reactor.connectTCP(member.address.host, member.address.port, factory)
-
-        threads.blockingCallFromThread(reactor, push)
+        threads.blockingCallFromThread(reactor, self.connection_pool.push, member, data_strings,
+                                       ignore_for_statistics)
 
     def push_to_random(self) -> None:
         """
         Pushes to a random, known member
         :return: None
         """
-        with self.hashgraph.lock:
-            filtered_known_members = [m for key, m in self.hashgraph.known_members.items()
-                                      if key != self.hashgraph.me.verify_key
-                                      and m.address is not None
-                                      and key not in self.hashgraph.fork_blacklist]
+        snapshot = self.hashgraph.snapshot
+        filtered_known_members = [m for key, m in snapshot.known_members.items()
+                                  if key != snapshot.me.verify_key
+                                  and m.address is not None
+                                  and key not in self.hashgraph.fork_blacklist
+                                  and self.connection_pool.is_available(m)]
 
         if filtered_known_members:
             member = choice(filtered_known_members)
@@ -169,23 +223,46 @@ class Network:
 
         return event
 
-    def receive_data_string_callback(self, data_string, peer):
+    def receive_data_string_callback(self, data_string, peer, session=None):
         """Turn a received data string over to the responsible thread."""
 
-        try:
-            self.background_push_server_thread.q.put((data_string, peer), block=False)
-        except:
-            pass
+        self.background_push_server_thread.q.put(data_string, peer, session)
 
-    def process_data_string(self, data_string, peer):
-        """Process a received data string."""
-
-        # Decode received JSON data
-        try:
-            received_data = json.loads(data_string)
-        except:
-            bptc.logger.warn("Could not parse JSON message")
-            return
+    def process_data_strings(self, pushes) -> None:
+        """
+        Processes received data strings. Pushes from the same member are merged and processed at once.
+        :param pushes: List of (data string, peer, session)
+        :return: None
+        """
+        # {member-id => (received data, peer, session)}
+        merged_pushes = OrderedDict()
+        for data_string, peer, session in pushes:
+            # Decode received data - the events we already know are skipped
+            try:
+                received_data = decode_message(data_string, self.hashgraph.lookup_table)
+            except:
+                bptc.logger.warn("Could not parse message")
+                continue
+
+            member_id = received_data['from']['verify_key']
+            if member_id not in merged_pushes:
+                merged_pushes[member_id] = (received_data, peer, session)
+                continue
+
+            # The latest push tells the latest state of the sender
+            merged_data, _, merged_session = merged_pushes[member_id]
+            received_data['events'] = OrderedDict(list(merged_data['events'].items()) +
+                                                  list(received_data['events'].items()))
+            received_data['members'] = merged_data['members'] + received_data['members']
+            received_data['skipped_events'] += merged_data['skipped_events']
+            merged_pushes[member_id] = (received_data, peer, session or merged_session)
+            self.background_push_server_thread.q.merged += 1
+
+        for received_data, peer, session in merged_pushes.values():
+            self.process_received_data(received_data, peer, session)
+
+    def process_received_data(self, received_data, peer, session=None):
+        """Process a decoded push. Pushes received over a session make it available for pushing back."""
 
         # Ignore pushes from yourself (should only happen once after the client is started)
         if received_data['from']['verify_key'] == self.me.verify_key:
@@ -194,29 +271,31 @@ class Network:
         # Log
         self.last_push_received = datetime.now().isoformat()
 
+        reactor.callFromThread(self.connection_pool.received_from, received_data['from']['verify_key'], session)
+
         # Generate Member object
         from_member_id = received_data['from']['verify_key']
         from_member_listening_port = int(received_data['from']['listening_port'])
         from_member = Member(from_member_id, None)
         from_member.address = peer
         from_member.address.port = from_member_listening_port
+        from_member.protocol_version = int(received_data['from'].get('protocol_version', 1))
+        if received_data['from'].get('heads') is not None:
+            from_member.announced_heads = dict(received_data['from']['heads'])
 
-        # Check if the sender sent any events
-        s_events = received_data['events']
-        if len(s_events) > 0:
-            events = {}
-            for event_id, dict_event in s_events.items():
-                events[event_id] = Event.from_dict(dict_event)
+        # Every push tells the sender's address, protocol version and heads
+        from_member = self.update_member(from_member)
 
-            bptc.logger.debug('- Received {} events'.format(len(events.items())))
+        # Check if the sender sent any events. A gossip event is created even if we knew all of them.
+        events = received_data['events']
+        if len(events) > 0 or received_data['skipped_events'] > 0:
+            bptc.logger.debug('- Received {} new events'.format(len(events)))
 
             self.process_events(from_member, events)
 
         # Check if the sender sent any members
-        s_members = received_data['members']
-        if len(s_members) > 0:
-            members = [Member.from_dict(m) for m in s_members]
-
+        members = received_data['members']
+        if len(members) > 0:
             bptc.logger.debug('- Received {} members'.format(len(members)))
 
             self.receive_members_callback(members)
@@ -228,16 +307,28 @@ class Network:
         :param events: The list of events
         :return: None
         """
-        # Store/Update member
+        with self.hashgraph.lock:
+            from_member = self.update_member(from_member)
+
+            # Let the hashgraph process the events
+            self.hashgraph.process_events(from_member, events)
+
+    def update_member(self, from_member: Member) -> Member:
+        """
+        Stores a member we received a push from, or updates its address, protocol version and heads
+        :param from_member: The member from which the push was received
+        :return: The stored member
+        """
         with self.hashgraph.lock:
             if from_member.id in self.hashgraph.known_members:
                 self.hashgraph.known_members[from_member.id].address = from_member.address
-                from_member = self.hashgraph.known_members[from_member.id]
+                self.hashgraph.known_members[from_member.id].protocol_version = from_member.protocol_version
+                self.hashgraph.known_members[from_member.id].announced_heads = from_member.announced_heads
+                return self.hashgraph.known_members[from_member.id]
             else:
                 self.hashgraph.known_members[from_member.id] = from_member
-
-            # Let the hashgraph process the events
-            self.hashgraph.process_events(from_member, events)
+                self.hashgraph.update_snapshot()
+                return from_member
 
     def receive_members_callback(self, members: List[Member]) -> None:
         """
@@ -251,6 +342,7 @@ class Network:
                     self.hashgraph.known_members[member.id] = member
                 elif self.hashgraph.known_members[member.id].address is None:
                     self.hashgraph.known_members[member.id].address = member.address
+            self.hashgraph.update_snapshot()
 
     def start_push_thread(self) -> None:
         """Start the thread responsible for frequent pushing."""
@@ -264,6 +356,118 @@ class Network:
 
         self.background_push_client_thread.stop()
 
+    def stop_push_server_thread(self) -> None:
+        """Stop processing received pushes and wait until the push being processed is done."""
+
+        self.background_push_server_thread.stop()
+        self.background_push_server_thread.join()
+
+
+class ConnectionPool:
+    """
+    Keeps sessions to other members, so pushes don't need a connection each. Members who don't support sessions get
+    a connection per push. Failed connection attempts are retried with an exponential backoff.
+    All methods except is_available are called in the thread of the reactor.
+    """
+
+    def __init__(self, network):
+        self.network = network
+
+        # {member-id => PushSession/PushServer}: The open sessions, opened by either side
+        self.sessions = {}
+
+        # {member-id => [bytes]}: The data strings of the latest push for each member whose session is being opened
+        self.pending = {}
+
+        # {member-id => int}: The number of consecutive failed connection attempts
+        self.failures = defaultdict(int)
+
+        # {member-id => float}: The time before which no connection to a member is attempted
+        self.retry_at = {}
+
+    def is_available(self, member: Member) -> bool:
+        """Whether a member can be pushed to - it has a session, or no connection attempt failed recently."""
+        return member.id in self.sessions or time.time() >= self.retry_at.get(member.id, 0)
+
+    def push(self, member: Member, data_strings: List[bytes], ignore_for_statistics=False) -> None:
+        """
+        Sends a push to a member, over its session if there is one
+        :param member: The receiver
+        :param data_strings: The encoded push, see Network.generate_data_strings
+        :param ignore_for_statistics: Whether the push doesn't count as sent push
+        :return: None
+        """
+        session = self.sessions.get(member.id)
+        if session is not None:
+            for data_string in data_strings:
+                session.send(data_string)
+            if not ignore_for_statistics:
+                self.network.last_push_sent = datetime.now().isoformat()
+            return
+
+        if member.address is None or not self.is_available(member):
+            return
+
+        if member.protocol_version < SESSION_VERSION:
+            compress = bptc.push_compression_level is not None and member.protocol_version >= COMPRESSION_VERSION
+            factory = PushClientFactory(data_strings, network=None if ignore_for_statistics else self.network,
+                                        receiver=member, compress=compress,
+                                        framed=member.protocol_version >= FRAMING_VERSION, connection_pool=self)
+            reactor.connectTCP(member.address.host, member.address.port, factory)
+            return
+
+        # Newer pushes replace older ones, as they contain everything the older ones contained
+        connecting = member.id in self.pending
+        self.pending[member.id] = data_strings
+        if not connecting:
+            factory = PushSessionFactory(self.network.receive_data_string_callback, self, member)
+            reactor.connectTCP(member.address.host, member.address.port, factory)
+
+    def session_opened(self, member_id: str, session) -> None:
+        """Registers a session we opened and sends the push waiting for it."""
+        self.failures.pop(member_id, None)
+        self.retry_at.pop(member_id, None)
+        self.sessions[member_id] = session
+
+        data_strings = self.pending.pop(member_id, None)
+        if data_strings is not None:
+            for data_string in data_strings:
+                session.send(data_string)
+            self.network.last_push_sent = datetime.now().isoformat()
+
+    def received_from(self, member_id: str, session=None) -> None:
+        """
+        Called for every received push. The member is reachable again, and its session can be used to push back.
+        :param member_id: The sender
+        :param session: The session the push was received on, or None
+        :return: None
+        """
+        self.failures.pop(member_id, None)
+        self.retry_at.pop(member_id, None)
+        if session is not None and member_id not in self.sessions and session.connected:
+            session.member_id = member_id
+            self.sessions[member_id] = session
+
+    def session_closed(self, session) -> None:
+        if session.member_id is not None and self.sessions.get(session.member_id) is session:
+            del self.sessions[session.member_id]
+
+    def connection_failed(self, member: Member) -> None:
+        """Delays the next connection attempt to a member exponentially with the number of failed attempts."""
+        self.pending.pop(member.id, None)
+        self.failures[member.id] += 1
+        delay = min(bptc.reconnect_max_delay, bptc.reconnect_min_delay * 2 ** (self.failures[member.id] - 1))
+        self.retry_at[member.id] = time.time() + random.uniform(0.5, 1) * delay
+        bptc.logger.debug("Connecting to {} failed {} times, next attempt in {:.0f}s".format(
+            member, self.failures[member.id], self.retry_at[member.id] - time.time()))
+
+    def close(self) -> None:
+        """Closes all sessions and drops the pushes waiting for a session."""
+        for session in list(self.sessions.values()):
+            session.transport.loseConnection()
+        self.sessions.clear()
+        self.pending.clear()
+
 
 class PushingClientThread(threading.Thread):
     """Thread responsible for frequent pushing to random members."""
@@ -285,6 +489,65 @@ class PushingClientThread(threading.Thread):
         return self._stop_event.is_set()
 
 
+class IngestQueue:
+    """
+    The received pushes waiting to be processed. They are taken out all at once, so pushes which arrived while the
+    previous ones were processed can be merged. If the queue is full, the oldest pushes are dropped - newer pushes of
+    the same member contain the events of older ones (unless they were received in the meantime).
+    """
+
+    def __init__(self, max_size: int, max_bytes: int):
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+
+        # [(data string, peer, session)]: The pushes, oldest first
+        self.pushes = deque()
+        self.bytes = 0
+        self.condition = threading.Condition()
+        # Whether no more pushes are taken, see close
+        self.closed = False
+
+        # Statistics
+        self.received = 0
+        self.dropped = 0
+        self.merged = 0
+
+    def put(self, data_string: bytes, peer, session=None) -> None:
+        """Adds a push without blocking, dropping the oldest pushes if the queue is full."""
+        with self.condition:
+            if self.closed:
+                return
+            self.pushes.append((data_string, peer, session))
+            self.bytes += len(data_string)
+            self.received += 1
+            while len(self.pushes) > self.max_size or (self.bytes > self.max_bytes and len(self.pushes) > 1):
+                self.bytes -= len(self.pushes.popleft()[0])
+                self.dropped += 1
+                bptc.logger.debug('Ingest queue is full - dropped a push ({} so far)'.format(self.dropped))
+            self.condition.notify()
+
+    def get_all(self) -> List:
+        """Waits for pushes and takes out all of them, oldest first. Returns an empty list once the queue is closed."""
+        with self.condition:
+            while len(self.pushes) == 0 and not self.closed:
+                self.condition.wait()
+            pushes = list(self.pushes)
+            self.pushes.clear()
+            self.bytes = 0
+            return pushes
+
+    def close(self) -> None:
+        """Drops the waiting pushes and all pushes added later, and wakes up whoever waits for pushes."""
+        with self.condition:
+            self.closed = True
+            self.pushes.clear()
+            self.bytes = 0
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.pushes)
+
+
 class PushingServerThread(threading.Thread):
     """Thread responsible for processing the received pushes."""
 
@@ -292,16 +555,17 @@ class PushingServerThread(threading.Thread):
         super(PushingServerThread, self).__init__()
         self.network = network
         self._stop_event = threading.Event()
-        self.q = queue.Queue(maxsize=1)
+        self.q = IngestQueue(bptc.ingest_queue_size, bptc.ingest_queue_bytes)
 
     def run(self):
         while not self.stopped():
-            (data_string, peer) = self.q.get()
-            self.network.process_data_string(data_string, peer)
-            self.q.task_done()
+            data_strings = self.q.get_all()
+            if not self.stopped():
+                self.network.process_data_strings(data_strings)
 
     def stop(self):
         self._stop_event.set()
+        self.q.close()
 
     def stopped(self):
         return self._stop_event.is_set()
@@ -318,7 +582,7 @@ class BootstrapPushThread(threading.Thread):
         self.network = network
 
     def run(self):
-        while len(self.network.hashgraph.known_members) == 1:
+        while len(self.network.hashgraph.snapshot.known_members) == 1:
             self.network.push_to(self.ip, int(self.port))
             time.sleep(2)
 
@@ -350,7 +614,8 @@ def start_listening(network, listening_ip, listening_port, allow_reset_signal):
     """Makes twisted's reactor listen for pushes and pulls"""
 
     bptc.logger.info("Push server listens on port {}".format(listening_port))
-    push_server_factory = PushServerFactory(network.receive_data_string_callback, allow_reset_signal, network)
+    push_server_factory = PushServerFactory(network.receive_data_string_callback, allow_reset_signal, network,
+                                            network.connection_pool)
     reactor.listenTCP(interface=listening_ip, port=int(listening_port), factory=push_server_factory)
 
     bptc.logger.info("[Pull server (for viz tool) listens on port {}]".format(int(listening_port) + 1))
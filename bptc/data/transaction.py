@@ -14,7 +14,13 @@ class TransactionStatus:
 
 
 class Transaction:
-    """A Transaction is a piece of information stored in an event."""
+    """
+    A Transaction is a piece of information stored in an event.
+    Transactions are part of the signed body of their event, so they can't be changed after construction - except
+    for the status, which is determined locally once the event is ordered.
+    """
+
+    __slots__ = ('receiver', 'amount', 'comment', 'status')
 
     def __init__(self, receiver, amount, comment=""):
         self.receiver = receiver
@@ -22,6 +28,14 @@ class Transaction:
         self.comment = comment
         self.status = TransactionStatus.UNCONFIRMED
 
+    def __setattr__(self, key, value):
+        if key != 'status' and hasattr(self, key):
+            raise AttributeError("Transactions can't be changed")
+        super().__setattr__(key, value)
+
+    def __delattr__(self, key):
+        raise AttributeError("Transactions can't be changed")
+
     def __str__(self):
         return "Transaction(receiver={}, amount={}, comment={})".format(self.receiver, self.amount, self.comment)
 
@@ -49,6 +63,8 @@ class Transaction:
 class MoneyTransaction(Transaction):
     """This transaction type is used for transferring money."""
 
+    __slots__ = ()
+
     def __str__(self):
         return "MoneyTransaction(receiver={}, amount={}, comment={})".format(self.receiver, self.amount, self.comment)
 
@@ -63,6 +79,8 @@ class MoneyTransaction(Transaction):
 class PublishNameTransaction(Transaction):
     """This transaction type is used for publishing the own name."""
 
+    __slots__ = ()
+
     def __init__(self, name):
         super().__init__(None, 0, name)
 
@@ -0,0 +1,438 @@
+import binascii
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict
+from twisted.internet.address import IPv4Address
+from bptc.data.event import Event, Parents
+from bptc.data.member import Member
+from bptc.data.transaction import Transaction, MoneyTransaction, PublishNameTransaction
+import bptc
+
+"""
+Codecs for the messages of the push protocol. A message is a dict of the form
+{'from': {'verify_key', 'listening_port', 'protocol_version', 'heads'}, 'events': {event-hash => Event},
+ 'members': [Member]}. Decoded messages tell how many known events were skipped as well ('skipped_events').
+The JSON codec is understood by all versions. The binary codecs are only used for members who announced a protocol
+version that supports them - receivers recognize them by their magic prefix.
+"""
+
+
+class JSONCodec:
+    """The original encoding: JSON with base64 encoded hashes, keys and signatures."""
+
+    def __init__(self, detached_signatures: bool = True):
+        # Whether to use detached signatures or the legacy format
+        self.detached_signatures = detached_signatures
+
+    def encode(self, message: Dict) -> bytes:
+        data = {
+            'from': message['from'],
+            'events': {event_id: event.to_dict(self.detached_signatures)
+                       for event_id, event in message['events'].items()},
+            'members': [member.to_dict() for member in message['members']]
+        }
+        return json.dumps(data).encode('UTF-8')
+
+    def decode(self, data: bytes, known_events=()) -> Dict:
+        """
+        Decodes a message
+        :param data: The encoded message
+        :param known_events: Hashes of events which don't need to be decoded
+        :return: The message, without the known events
+        """
+        data = json.loads(data.decode('UTF-8'))
+        events = OrderedDict((event_id, Event.from_dict(dict_event)) for event_id, dict_event
+                             in data['events'].items() if event_id not in known_events)
+        return {
+            'from': data['from'],
+            'events': events,
+            'members': [Member.from_dict(m) for m in data['members']],
+            'skipped_events': len(data['events']) - len(events)
+        }
+
+
+class BinaryCodec:
+    """
+    A compact encoding. Hashes, keys and signatures are sent as raw bytes, integers as varints. Verify keys are sent
+    once per message in a table and referred to by their position in it. Each event is prefixed with its length, so
+    known events can be skipped without decoding them.
+    """
+
+    MAGIC = b'BPTC\x01'
+
+    # Types of transactions. Transactions that don't fit into the compact types are sent as JSON.
+    MONEY_TRANSACTION = 0
+    PUBLISH_NAME_TRANSACTION = 1
+    JSON_TRANSACTION = 2
+
+    # Types of verify keys in the table
+    RAW_KEY = 0
+    STRING_KEY = 1
+
+    def encode(self, message: Dict) -> bytes:
+        keys = KeyTable()
+        out = self.encode_header(message, keys)
+
+        write_varint(out, len(message['events']))
+        for event_id, event in message['events'].items():
+            record = self.encode_event(event, keys)
+            write_varint(out, len(record))
+            out += record
+
+        result = bytearray(self.MAGIC)
+        keys.write(result)
+        return bytes(result + out)
+
+    def encode_header(self, message: Dict, keys: 'KeyTable') -> bytearray:
+        """Encodes the sender, its heads and the members of a message - everything before the events."""
+        out = bytearray()
+
+        sender = message['from']
+        keys.index(sender['verify_key'])
+        write_varint(out, sender['listening_port'])
+        write_varint(out, sender['protocol_version'])
+
+        heads = sender.get('heads') or {}
+        write_varint(out, len(heads))
+        for member_id, event_id in heads.items():
+            write_varint(out, keys.index(member_id))
+            out += decode_hash(event_id)
+
+        write_varint(out, len(message['members']))
+        for member in message['members']:
+            write_varint(out, keys.index(member.verify_key))
+            write_string(out, member.host)
+            write_varint(out, member.port)
+        return out
+
+    def encode_event(self, event: Event, keys: 'KeyTable') -> bytearray:
+        out = bytearray(decode_hash(event.id))
+        self.write_key(out, event.verify_key, keys)
+        out.append((event.parents.self_parent is not None) | (event.parents.other_parent is not None) << 1)
+        for parent in event.parents:
+            if parent is not None:
+                out += decode_hash(parent)
+        write_string(out, event.time)
+
+        if event.data is None:
+            write_varint(out, 0)
+        else:
+            write_varint(out, len(event.data) + 1)
+            for transaction in event.data:
+                if type(transaction) is MoneyTransaction and type(transaction.amount) is int and \
+                        isinstance(transaction.receiver, str) and isinstance(transaction.comment, str):
+                    out.append(self.MONEY_TRANSACTION)
+                    self.write_key(out, transaction.receiver, keys)
+                    write_varint(out, zigzag(transaction.amount))
+                    write_string(out, transaction.comment)
+                elif type(transaction) is PublishNameTransaction and isinstance(transaction.name, str):
+                    out.append(self.PUBLISH_NAME_TRANSACTION)
+                    write_string(out, transaction.name)
+                else:
+                    out.append(self.JSON_TRANSACTION)
+                    write_string(out, json.dumps(transaction.to_dict()))
+
+        out += decode_hash(event.signature)
+        return out
+
+    def write_key(self, out: bytearray, key: str, keys: 'KeyTable') -> None:
+        """Writes a verify key (or other member id) of an event, as its position in the key table."""
+        write_varint(out, keys.index(key))
+
+    def read_key(self, reader: 'Reader', keys: 'KeyTable') -> str:
+        return keys[reader.varint()]
+
+    def decode(self, data: bytes, known_events=()) -> Dict:
+        """
+        Decodes a message
+        :param data: The encoded message
+        :param known_events: Hashes of events which don't need to be decoded
+        :return: The message, without the known events
+        """
+        if not data.startswith(self.MAGIC):
+            raise ValueError('Not a binary message')
+        reader = Reader(data, len(self.MAGIC))
+
+        keys = KeyTable.read(reader)
+        sender = {
+            'verify_key': keys[0],
+            'listening_port': reader.varint(),
+            'protocol_version': reader.varint(),
+            'heads': {}
+        }
+        for _ in range(reader.varint()):
+            member_id = keys[reader.varint()]
+            sender['heads'][member_id] = encode_hash(reader.bytes(64))
+
+        members = []
+        for _ in range(reader.varint()):
+            member = Member(keys[reader.varint()], None)
+            host = reader.string()
+            member.address = IPv4Address('TCP', host, reader.varint())
+            members.append(member)
+
+        events = OrderedDict()
+        event_count = reader.varint()
+        for _ in range(event_count):
+            length = reader.varint()
+            end = reader.position + length
+            event_id = encode_hash(reader.bytes(64))
+            if event_id not in known_events:
+                events[event_id] = self.decode_event(reader, keys)
+            reader.position = end
+
+        return {'from': sender, 'events': events, 'members': members, 'skipped_events': event_count - len(events)}
+
+    def decode_event(self, reader: 'Reader', keys) -> Event:
+        verify_key = self.read_key(reader, keys)
+        flags = reader.bytes(1)[0]
+        parents = reader.bytes(64 * ((flags & 1) + (flags >> 1 & 1)))
+        self_parent = encode_hash(parents[:64]) if flags & 1 else None
+        other_parent = encode_hash(parents[-64:]) if flags & 2 else None
+        time = reader.string()
+
+        data = None
+        length = reader.varint()
+        if length > 0:
+            data = []
+            for _ in range(length - 1):
+                transaction_type = reader.bytes(1)[0]
+                if transaction_type == self.MONEY_TRANSACTION:
+                    receiver = self.read_key(reader, keys)
+                    amount = unzigzag(reader.varint())
+                    data.append(MoneyTransaction(receiver, amount, reader.string()))
+                elif transaction_type == self.PUBLISH_NAME_TRANSACTION:
+                    data.append(PublishNameTransaction(reader.string()))
+                elif transaction_type == self.JSON_TRANSACTION:
+                    data.append(Transaction.from_dict(json.loads(reader.string())))
+                else:
+                    raise ValueError('Unknown transaction type: {}'.format(transaction_type))
+
+        event = Event(verify_key, data, Parents(self_parent, other_parent), time)
+        event.signature = encode_hash(reader.bytes(64))
+        return event
+
+
+class CachedBinaryCodec(BinaryCodec):
+    """
+    The binary codec with events which don't refer to the key table of the message - their keys are part of them.
+    So the encoding of an event is the same in every message, and is cached (see EventRecordCache). Compression
+    makes up for the repeated keys.
+    """
+
+    MAGIC = b'BPTC\x02'
+
+    def __init__(self, cache: 'EventRecordCache' = None):
+        self.cache = cache if cache is not None else event_records
+
+    def encode(self, message: Dict) -> bytes:
+        keys = KeyTable()
+        out = self.encode_header(message, keys)
+
+        # The events are only concatenated
+        write_varint(out, len(message['events']))
+        get_record = self.cache.get_record
+        parts = [get_record(event, self.encode_record) for event in message['events'].values()]
+
+        result = bytearray(self.MAGIC)
+        keys.write(result)
+        result += out
+        return b''.join([result] + parts)
+
+    def encode_record(self, event: Event) -> bytes:
+        """Returns the encoding of an event, prefixed with its length."""
+        record = self.encode_event(event, None)
+        out = bytearray()
+        write_varint(out, len(record))
+        return bytes(out + record)
+
+    def write_key(self, out: bytearray, key: str, keys: 'KeyTable') -> None:
+        write_key(out, key)
+
+    def read_key(self, reader: 'Reader', keys: 'KeyTable') -> str:
+        return read_key(reader)
+
+
+class EventRecordCache:
+    """
+    The encodings of recently pushed events, so events are only encoded once however often they are pushed.
+    The least recently used encodings are dropped once they need more than bptc.event_record_cache_size bytes.
+    """
+
+    # The approximate memory needed for an entry besides the encoding itself
+    ENTRY_OVERHEAD = 200
+
+    def __init__(self):
+        # {(event-hash, signature) => bytes}: The encodings, least recently used first. The hash covers the body of
+        # the event, so an entry only matches an event that is identical to the encoded one.
+        self.records = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get_record(self, event: Event, encode) -> bytes:
+        """
+        Returns the cached encoding of an event, encoding and caching it if needed
+        :param event: The event
+        :param encode: Function encoding an event
+        :return: The encoding
+        """
+        key = (event.id, event.signature)
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None:
+                self.records.move_to_end(key)
+                self.hits += 1
+                return record
+
+        record = encode(event)
+        with self.lock:
+            self.misses += 1
+            if key not in self.records:
+                self.records[key] = record
+                self.size += len(record) + self.ENTRY_OVERHEAD
+                while self.size > bptc.event_record_cache_size and len(self.records) > 0:
+                    _, dropped = self.records.popitem(last=False)
+                    self.size -= len(dropped) + self.ENTRY_OVERHEAD
+        return record
+
+    def clear(self) -> None:
+        with self.lock:
+            self.records.clear()
+            self.size = 0
+
+
+# The cache used by default
+event_records = EventRecordCache()
+
+
+def decode_message(data: bytes, known_events=()) -> Dict:
+    """Decodes a message in any of the codecs."""
+    if data.startswith(CachedBinaryCodec.MAGIC):
+        return CachedBinaryCodec().decode(data, known_events)
+    if data.startswith(BinaryCodec.MAGIC):
+        return BinaryCodec().decode(data, known_events)
+    return JSONCodec().decode(data, known_events)
+
+
+class KeyTable:
+    """The verify keys (and other member ids) of a message, referred to by their position."""
+
+    def __init__(self, keys=None):
+        self.keys = keys or []
+        self.positions = {key: i for i, key in enumerate(self.keys)}
+
+    def __getitem__(self, position: int) -> str:
+        return self.keys[position]
+
+    def index(self, key: str) -> int:
+        if key not in self.positions:
+            self.positions[key] = len(self.keys)
+            self.keys.append(key)
+        return self.positions[key]
+
+    def write(self, out: bytearray) -> None:
+        write_varint(out, len(self.keys))
+        for key in self.keys:
+            write_key(out, key)
+
+    @classmethod
+    def read(cls, reader: 'Reader') -> 'KeyTable':
+        return cls([read_key(reader) for _ in range(reader.varint())])
+
+
+class Reader:
+    """Reads the parts of a binary message one after another."""
+
+    def __init__(self, data: bytes, position: int = 0):
+        self.data = bytes(data)
+        self.position = position
+
+    def bytes(self, length: int) -> bytes:
+        result = self.data[self.position:self.position + length]
+        if len(result) != length:
+            raise ValueError('Message is truncated')
+        self.position += length
+        return result
+
+    def varint(self) -> int:
+        data = self.data
+        try:
+            byte = data[self.position]
+            self.position += 1
+            if byte < 0x80:
+                return byte
+
+            result = byte & 0x7f
+            shift = 7
+            while True:
+                byte = data[self.position]
+                self.position += 1
+                result |= (byte & 0x7f) << shift
+                if byte < 0x80:
+                    return result
+                shift += 7
+        except IndexError:
+            raise ValueError('Message is truncated')
+
+    def string(self) -> str:
+        return self.bytes(self.varint()).decode('UTF-8')
+
+
+def write_varint(out: bytearray, value: int) -> None:
+    """Appends a non-negative integer, 7 bits per byte (LEB128)."""
+    if value < 0:
+        raise ValueError('Varints must not be negative')
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def write_key(out: bytearray, key: str) -> None:
+    """Appends a verify key (or other member id) - raw if it survives the round trip, otherwise as text."""
+    raw = decode_hash(key) if len(key) == 44 else b''
+    if len(raw) == 32 and encode_hash(raw) == key:
+        out.append(BinaryCodec.RAW_KEY)
+        out += raw
+    else:
+        out.append(BinaryCodec.STRING_KEY)
+        write_string(out, key)
+
+
+def read_key(reader: 'Reader') -> str:
+    key_type = reader.bytes(1)[0]
+    if key_type == BinaryCodec.RAW_KEY:
+        return encode_hash(reader.bytes(32))
+    elif key_type == BinaryCodec.STRING_KEY:
+        return reader.string()
+    raise ValueError('Unknown key type: {}'.format(key_type))
+
+
+def write_string(out: bytearray, value: str) -> None:
+    encoded = value.encode('UTF-8')
+    write_varint(out, len(encoded))
+    out += encoded
+
+
+def zigzag(value: int) -> int:
+    """Maps signed integers to non-negative ones, so small negative numbers stay small."""
+    return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def unzigzag(value: int) -> int:
+    return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+
+def decode_hash(value: str) -> bytes:
+    """Returns the raw bytes of a base64 encoded hash, key or signature."""
+    return binascii.a2b_base64(value)
+
+
+def encode_hash(raw: bytes) -> str:
+    """Returns the base64 encoding of a hash, key or signature, as used in the rest of the application."""
+    return binascii.b2a_base64(raw, newline=False).decode('UTF-8')
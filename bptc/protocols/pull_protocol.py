@@ -25,9 +25,8 @@ class PullServer(protocol.Protocol):
 
     def connectionMade(self):
         serialized_events = {}
-        with self.factory.hashgraph.lock:
-            for event_id, event in self.factory.hashgraph.lookup_table.items():
-                serialized_events[event_id] = event.to_debug_dict()
+        for event in self.factory.hashgraph.snapshot.events:
+            serialized_events[event.id] = event.to_debug_dict()
 
         data_string = {'from': self.factory.me_id, 'events': serialized_events}
         data_to_send = zlib.compress(json.dumps(data_string).encode('UTF-8'))
@@ -1,88 +1,302 @@
 from datetime import datetime
+import struct
 import zlib
-from math import ceil
+from typing import List
 from twisted.internet import protocol
+from twisted.protocols.policies import TimeoutMixin
 import bptc
 
-"""The push protocol is used between two clients for pushing events."""
+"""
+The push protocol is used between two clients for pushing events. A push is either sent over its own connection
+(which is closed afterwards), or as a frame over a session - a long-lived connection on which both members push.
+"""
+
+
+# Compressed pushes start with this prefix, followed by a zlib stream
+ZLIB_PREFIX = b'BPTZ'
+
+# Framed pushes start with this prefix and a byte of flags, followed by the stream of frames. Each frame is a
+# message, prefixed with its length (4 bytes, big-endian).
+FRAMED_PREFIX = b'BPTF'
+FRAME_HEADER = struct.Struct('!I')
+
+# Flags of framed pushes
+COMPRESSED = 1
+SESSION = 2  # The connection is kept open and frames are sent in both directions
+
+# The size of the chunks that are written to the transport (and decompressed at once)
+CHUNK_SIZE = 65536
+
+
+class FrameTooLarge(Exception):
+    pass
+
+
+class FrameDecoder:
+    """Splits a stream into frames. The data of incomplete frames is kept until the rest of the frame arrives."""
+
+    def __init__(self, max_frame_size: int):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        """
+        Adds received data
+        :param data: The next part of the stream
+        :return: The frames completed by the data
+        """
+        self.buffer += data
+        frames = []
+        position = 0
+        while len(self.buffer) - position >= FRAME_HEADER.size:
+            length, = FRAME_HEADER.unpack_from(self.buffer, position)
+            if length > self.max_frame_size:
+                raise FrameTooLarge('Frame of {} bytes exceeds the maximum of {} bytes'.format(
+                    length, self.max_frame_size))
+            end = position + FRAME_HEADER.size + length
+            if end > len(self.buffer):
+                break
+            frames.append(bytes(self.buffer[position + FRAME_HEADER.size:end]))
+            position = end
+        del self.buffer[:position]
+        return frames
+
+    @property
+    def incomplete(self) -> bool:
+        return len(self.buffer) > 0
+
+
+def encode_frame(message: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(message)) + message
+
+
+def write_chunks(transport, data: bytes, compressor=None) -> None:
+    """Writes data to a transport in chunks, compressing each chunk if a compressor is given."""
+    for i in range(0, len(data), CHUNK_SIZE):
+        chunk = data[i:i + CHUNK_SIZE]
+        if compressor is not None:
+            chunk = compressor.compress(chunk)
+        if len(chunk) > 0:
+            transport.write(chunk)
 
 
 class PushServerFactory(protocol.ServerFactory):
 
-    def __init__(self, receive_data_string_callback, allow_reset_signal=False, network=None):
+    def __init__(self, receive_data_string_callback, allow_reset_signal=False, network=None, connection_pool=None):
         self.receive_data_string_callback = receive_data_string_callback
         self.allow_reset_signal = allow_reset_signal
         self.protocol = PushServer
-        self.received_data = b""
         self.network = network
+        # Is told about closed sessions
+        self.connection_pool = connection_pool
 
 
-class PushServer(protocol.Protocol):
-    """The push server handles the pushes of a push client."""
+class PushServer(protocol.Protocol, TimeoutMixin):
+    """
+    The push server handles the pushes of a push client. Each connection has its own buffers. Framed pushes are
+    handed over frame by frame as soon as a frame is complete, unframed pushes when the connection is closed.
+    Compressed pushes are decompressed as their chunks arrive.
+    If the client opens a session, the server answers with its own header and can send frames back over the
+    connection.
+    """
 
     def connectionMade(self):
         # Don't call transport.write at this point - all received data might be gone
-        pass
+        # The data of an unframed push
+        self.received_data = bytearray()
+        # The frames of a framed push, None for unframed pushes
+        self.frames = None
+
+        # The first bytes, until we know the format of the push
+        self.header = b''
+        self.header_received = False
+
+        self.decompressor = None
+        # Whether the push was rejected
+        self.failed = False
+
+        # Whether the connection is a session
+        self.session = False
+        # Compresses the frames sent over the session, None if they are not compressed
+        self.compressor = None
+        # The member on the other side of the session, once it is known
+        self.member_id = None
 
     def dataReceived(self, data):
-        if data[:3] == b'GET':
-            if self.factory.allow_reset_signal and data[4:11] == b'/?reset':
-                self.transport.write('Resetting the local hashgraph!'.encode('UTF-8'))
-                bptc.logger.warn('Deleting local database containing the hashgraph')
-                self.network.reset()
-            else:
-                self.transport.write('I\'m alive!'.encode('UTF-8'))
-            self.transport.loseConnection()
+        if self.failed:
+            return
+        self.resetTimeout()
+
+        if not self.header_received:
+            self.header += data
+            if len(self.header) <= len(FRAMED_PREFIX) and \
+                    (FRAMED_PREFIX.startswith(self.header[:4]) or ZLIB_PREFIX.startswith(self.header[:4])):
+                return
+            data = self.header
+            self.header = b''
+            self.header_received = True
+
+            if data[:3] == b'GET':
+                if self.factory.allow_reset_signal and data[4:11] == b'/?reset':
+                    self.transport.write('Resetting the local hashgraph!'.encode('UTF-8'))
+                    bptc.logger.warn('Deleting local database containing the hashgraph')
+                    self.factory.network.reset()
+                else:
+                    self.transport.write('I\'m alive!'.encode('UTF-8'))
+                self.transport.loseConnection()
+                return
+
+            if data.startswith(FRAMED_PREFIX):
+                flags = data[len(FRAMED_PREFIX)]
+                self.frames = FrameDecoder(bptc.max_push_frame_size)
+                if flags & COMPRESSED:
+                    self.decompressor = zlib.decompressobj()
+                if flags & SESSION and not self.session:
+                    self.start_session()
+                data = data[len(FRAMED_PREFIX) + 1:]
+            elif data.startswith(ZLIB_PREFIX):
+                self.decompressor = zlib.decompressobj()
+                data = data[len(ZLIB_PREFIX):]
+
+        if self.decompressor is None:
+            self.receive(data)
             return
-        self.factory.received_data += data
+
+        # Decompress in chunks, so a small input can't expand to an arbitrary amount of memory at once
+        while len(data) > 0 and not self.failed:
+            try:
+                chunk = self.decompressor.decompress(data, CHUNK_SIZE)
+            except zlib.error as err:
+                self.reject('Failed decompressing input: {}'.format(err))
+                return
+            data = self.decompressor.unconsumed_tail
+            self.receive(chunk)
+
+    def receive(self, data: bytes) -> None:
+        """Handles the (decompressed) data of the push."""
+        if self.frames is None:
+            self.received_data += data
+            if len(self.received_data) > bptc.max_push_frame_size:
+                self.reject('Push exceeds the maximum of {} bytes'.format(bptc.max_push_frame_size))
+            return
+
+        try:
+            frames = self.frames.feed(data)
+        except FrameTooLarge as err:
+            self.reject(str(err))
+            return
+        for frame in frames:
+            self.factory.receive_data_string_callback(frame, self.transport.getPeer(), self if self.session else None)
+
+    def reject(self, reason: str) -> None:
+        bptc.logger.error('Rejected push from {}: {}'.format(self.transport.getPeer(), reason))
+        self.failed = True
+        self.received_data = bytearray()
+        self.transport.loseConnection()
+
+    def start_session(self) -> None:
+        """Writes the header of the frames sent over this connection, which stays open until it is idle."""
+        self.session = True
+        flags = SESSION
+        if bptc.push_compression_level is not None:
+            flags |= COMPRESSED
+            self.compressor = zlib.compressobj(bptc.push_compression_level)
+        self.transport.write(FRAMED_PREFIX + bytes([flags]))
+        self.setTimeout(bptc.session_idle_timeout)
+
+    def send(self, message: bytes) -> None:
+        """Sends a message as a frame over the session."""
+        write_chunks(self.transport, encode_frame(message), self.compressor)
+        if self.compressor is not None:
+            # Make the whole frame decompressable without waiting for more data
+            self.transport.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        # Only received data keeps the session open - see dataReceived
+
+    def timeoutConnection(self):
+        bptc.logger.debug('Closing idle session with {}'.format(self.transport.getPeer()))
+        self.transport.loseConnection()
 
     def connectionLost(self, reason):
-        if len(self.factory.received_data) == 0:
+        self.setTimeout(None)
+        if self.session and self.factory.connection_pool is not None:
+            self.factory.connection_pool.session_closed(self)
+        if self.failed:
+            return
+        if not self.header_received:
+            # Pushes shorter than the prefix
+            self.received_data += self.header
+
+        if self.frames is not None:
+            if self.frames.incomplete:
+                bptc.logger.error('Connection closed within a frame [length={}]'.format(len(self.frames.buffer)))
+            return
+        if len(self.received_data) == 0:
             bptc.logger.warn('No data received!')
             return
-        try:
-            # data = zlib.decompress(self.factory.received_data)
-            data = self.factory.received_data
-            self.factory.receive_data_string_callback(data.decode('UTF-8'), self.transport.getPeer())
-        except zlib.error as err:
-            bptc.logger.error(
-                'Failed parsing input: {}... [length={}] \n\n Error message: {}'.format(
-                    self.factory.received_data[:100], len(self.factory.received_data), err))
-        finally:
-            self.factory.received_data = b""
+        if self.decompressor is not None and not self.decompressor.eof:
+            bptc.logger.error('Compressed input is incomplete [length={}]'.format(len(self.received_data)))
+            return
+
+        self.factory.receive_data_string_callback(bytes(self.received_data), self.transport.getPeer())
 
 
 class PushClientFactory(protocol.ClientFactory):
+    """
+    Sends a single push over a new connection. A push split into several data strings is sent as several frames -
+    or over a connection each, one after the other, if the receiver doesn't understand framed pushes.
+    """
 
-    def __init__(self, string_to_send, network=None, receiver=None):
-        self.string_to_send = string_to_send
+    def __init__(self, strings_to_send: List[bytes], network=None, receiver=None, compress=False, framed=False,
+                 connection_pool=None):
+        # The data strings which weren't sent yet
+        self.strings_to_send = list(strings_to_send)
         self.protocol = PushClient
         self.network = network
         self.receiver = receiver
+        # Whether the receiver understands compressed pushes
+        self.compress = compress
+        # Whether the receiver understands framed pushes
+        self.framed = framed
+        # Is told about failed connections
+        self.connection_pool = connection_pool
 
     def clientConnectionLost(self, connector, reason):
         # Ignore failed connections because we expect this to happen
         if reason.getErrorMessage() != 'Connection was closed cleanly.':
             bptc.logger.error("Connection lost: {}".format(reason.getErrorMessage()))
-        pass
+            return
+
+        # The next part of an unframed push
+        if len(self.strings_to_send) > 0:
+            connector.connect()
 
     def clientConnectionFailed(self, connector, reason):
-        # Count how often a connection to someone failed
-        if self.receiver:
-            self.receiver.push_fail_count += 1
-            if self.receiver.push_fail_count >= 3:
-                self.receiver.address = None
-                bptc.logger.debug("Forgot address of {} after three failed attempts".format(self.receiver))
+        if self.receiver is not None and self.connection_pool is not None:
+            self.connection_pool.connection_failed(self.receiver)
 
 
 class PushClient(protocol.Protocol):
-    """The push client pushes to a push server."""
+    """The push client pushes to a push server. The data is compressed chunk by chunk while it is written."""
 
     def connectionMade(self):
-        # data_to_send = zlib.compress(self.factory.string_to_send)
-        data_to_send = self.factory.string_to_send
-        for i in range(1, (ceil(len(data_to_send) / 65536)) + 1):
-            self.transport.write(data_to_send[(i-1) * 65536:min(i*65536, len(data_to_send))])
+        compressor = None
+        if self.factory.framed:
+            self.transport.write(FRAMED_PREFIX + bytes([COMPRESSED if self.factory.compress else 0]))
+            # All parts of the push are sent as frames over this connection
+            data_to_send = [encode_frame(data_string) for data_string in self.factory.strings_to_send]
+            self.factory.strings_to_send = []
+        else:
+            # One part per connection - the factory connects again for the next one
+            data_to_send = [self.factory.strings_to_send.pop(0)]
+            if self.factory.compress:
+                self.transport.write(ZLIB_PREFIX)
+        if self.factory.compress:
+            compressor = zlib.compressobj(bptc.push_compression_level)
+
+        for data in data_to_send:
+            write_chunks(self.transport, data, compressor)
+        if compressor is not None:
+            self.transport.write(compressor.flush())
         self.transport.loseConnection()
 
         if self.factory.network:
@@ -90,3 +304,28 @@ class PushClient(protocol.Protocol):
 
     def connectionLost(self, reason):
         pass
+
+
+class PushSessionFactory(protocol.ClientFactory):
+    """Opens a session to a member. The connection pool is told when the session is opened or closed."""
+
+    def __init__(self, receive_data_string_callback, connection_pool, member):
+        self.receive_data_string_callback = receive_data_string_callback
+        self.connection_pool = connection_pool
+        self.member = member
+        self.protocol = PushSession
+        self.allow_reset_signal = False
+        self.network = None
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connection_pool.connection_failed(self.member)
+
+
+class PushSession(PushServer):
+    """The client side of a session. Apart from opening it, it behaves like the server side."""
+
+    def connectionMade(self):
+        super().connectionMade()
+        self.member_id = self.factory.member.id
+        self.start_session()
+        self.factory.connection_pool.session_opened(self.member_id, self)
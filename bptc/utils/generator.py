@@ -0,0 +1,140 @@
+import datetime
+import random
+from typing import List, Tuple
+from libnacl import crypto_sign_seed_keypair
+from libnacl.encode import base64_encode
+from bptc.data.consensus import divide_rounds, decide_fame, find_order
+from bptc.data.event import Event, Parents
+from bptc.data.hashgraph import Hashgraph
+from bptc.data.member import Member
+
+"""Generates deterministic, synthetic hashgraphs, e.g. for benchmarks."""
+
+TOPOLOGIES = ['random', 'ring', 'star']
+
+
+def create_member(seed: int, stake: int = 1) -> Member:
+    """
+    Creates a member whose keys are derived from a seed
+    :param seed: The seed
+    :param stake: The stake of the member
+    :return: The member
+    """
+    verify_key_bytes, signing_key_bytes = crypto_sign_seed_keypair(seed.to_bytes(32, 'big'))
+    member = Member(base64_encode(verify_key_bytes).decode("UTF-8"), base64_encode(signing_key_bytes).decode("UTF-8"))
+    member.stake = stake
+    return member
+
+
+def choose_other_member(rnd: random.Random, members: List[Member], creator: Member, topology: str) -> Member:
+    """Chooses the member whose head becomes the other parent of a new event by the creator."""
+    creator_idx = members.index(creator)
+    if topology == 'ring':
+        # Everybody syncs with one of its neighbours
+        return members[(creator_idx + rnd.choice([-1, 1])) % len(members)]
+    elif topology == 'star' and creator_idx != 0:
+        # Everybody syncs with the first member, who syncs with everybody
+        return members[0]
+    else:
+        return rnd.choice([m for m in members if m is not creator])
+
+
+def generate_events(n_members: int, n_events: int, topology: str = 'random', fork_probability: float = 0.0,
+                    seed: int = 0, fork_delay: int = 0) -> Tuple[List[Member], List[Event]]:
+    """
+    Generates the events of members gossiping with each other
+    :param n_members: The number of members
+    :param n_events: The number of events, including the first event of each member
+    :param topology: Who gossips with whom - one of TOPOLOGIES
+    :param fork_probability: The probability that an event of the last member is a fork
+    :param seed: The seed for keys, times and gossip partners
+    :param fork_delay: The number of events after which a fork arrives. Until the last member creates its next event,
+    the others use a late fork as other parent. With 0, a fork arrives right after the original and nobody builds on it
+    :return: The members and their signed events, in topological order
+    """
+    if topology not in TOPOLOGIES:
+        raise ValueError('Unknown topology: {}'.format(topology))
+
+    rnd = random.Random(seed)
+    members = [create_member(seed * n_members + i + 1) for i in range(n_members)]
+    heads = {}
+    # {member-id => event-id}: The heads other members build on - the last fork that arrived, until its creator's
+    # next event
+    shared_heads = {}
+    # [(number of events, Event)]: Forks which arrive once there are that many events
+    late_forks = []
+    events = []
+
+    time = datetime.datetime(2017, 1, 1)
+    while len(events) < n_events:
+        while len(late_forks) > 0 and late_forks[0][0] <= len(events):
+            fork = late_forks.pop(0)[1]
+            events.append(fork)
+            shared_heads[fork.verify_key] = fork.id
+
+        time += datetime.timedelta(milliseconds=rnd.randint(1, 1000))
+        if len(events) < n_members:
+            creator = members[len(events)]
+            parents = Parents(None, None)
+        else:
+            creator = rnd.choice(members)
+            other = choose_other_member(rnd, members, creator, topology)
+            parents = Parents(heads[creator.id], shared_heads[other.id])
+
+        event = Event(creator.verify_key, None, parents, time.isoformat())
+        event.sign(creator.signing_key)
+        events.append(event)
+        heads[creator.id] = event.id
+        shared_heads[creator.id] = event.id
+
+        # Only the last member forks: it creates a second event on the same self-parent
+        if creator is members[-1] and parents.self_parent is not None and rnd.random() < fork_probability:
+            time += datetime.timedelta(milliseconds=1)
+            fork = Event(creator.verify_key, None, parents, time.isoformat())
+            fork.sign(creator.signing_key)
+            if fork_delay > 0:
+                late_forks.append((len(events) + fork_delay, fork))
+            else:
+                events.append(fork)
+
+    return members, events[:n_events]
+
+
+def generate_hashgraph(n_members: int, n_events: int, topology: str = 'random', fork_probability: float = 0.0,
+                       seed: int = 0, fork_delay: int = 0) -> Hashgraph:
+    """
+    Generates a hashgraph and calculates its consensus. The consensus is calculated after each batch of
+    n_members events, similar to receiving pushes.
+    :return: The hashgraph, seen by the first member
+    """
+    members, events = generate_events(n_members, n_events, topology, fork_probability, seed, fork_delay)
+    hg = create_hashgraph(members)
+    for i in range(0, len(events), n_members):
+        add_events(hg, events[i:i + n_members])
+        decide_fame(hg)
+        find_order(hg)
+    return hg
+
+
+def create_hashgraph(members: List[Member]) -> Hashgraph:
+    """Creates an empty hashgraph, seen by the first member, which knows (copies of) all members."""
+    copies = []
+    for member in members:
+        copy = Member(member.verify_key, member.signing_key)
+        copy.stake = member.stake
+        copies.append(copy)
+
+    hg = Hashgraph(copies[0])
+    for member in copies:
+        hg.known_members[member.id] = member
+    return hg
+
+
+def add_events(hg: Hashgraph, events: List[Event]) -> None:
+    """
+    Adds events in topological order to a hashgraph and divides them into rounds.
+    Events can only be added to a single hashgraph - use copies for others.
+    """
+    for event in events:
+        hg.add_event(event)
+    divide_rounds(hg, events)
@@ -0,0 +1,84 @@
+import math
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+import bptc
+
+"""
+Verifies the signatures of events in parallel. libnacl calls libsodium through ctypes, which releases the GIL
+while a signature is checked - so a thread pool spreads the verification over all cores.
+"""
+
+# The minimum number of events per batch. Smaller batches aren't worth the overhead of the pool.
+MIN_BATCH_SIZE = 16
+
+__executor = None
+__executor_workers = None
+
+# {(event-hash, signature) => None}: The most recently verified valid signatures, oldest first. The hash covers the
+# signed body, so a pair only matches an event that is identical to the verified one.
+__verified_signatures = OrderedDict()
+
+
+def get_executor(workers: int) -> ThreadPoolExecutor:
+    """
+    Returns the pool of verification threads, creating a new one if the number of workers changed
+    :param workers: The number of threads
+    :return: The pool
+    """
+    global __executor, __executor_workers
+    if __executor is None or __executor_workers != workers:
+        if __executor is not None:
+            __executor.shutdown(wait=False)
+        __executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verification')
+        __executor_workers = workers
+    return __executor
+
+
+def clear_cache() -> None:
+    """Forgets all verified signatures."""
+    __verified_signatures.clear()
+
+
+def verify_batch(events) -> List[bool]:
+    return [event.has_valid_signature for event in events]
+
+
+def verify_signatures(events, workers: int = None) -> List[bool]:
+    """
+    Checks the signatures of events, in batches on the verification pool. Signatures that were verified recently
+    are not checked again.
+    :param events: The events to be checked
+    :param workers: The number of threads to use - bptc.verification_workers by default
+    :return: For each event, whether its signature is valid
+    """
+    events = list(events)
+    if workers is None:
+        workers = bptc.verification_workers
+
+    result = [True] * len(events)
+    unverified = []
+    for i, event in enumerate(events):
+        key = (event.id, event.signature)
+        if key in __verified_signatures:
+            __verified_signatures.move_to_end(key)
+        else:
+            unverified.append(i)
+
+    if workers <= 1 or len(unverified) < 2 * MIN_BATCH_SIZE:
+        verified = verify_batch([events[i] for i in unverified])
+    else:
+        batch_size = max(MIN_BATCH_SIZE, int(math.ceil(len(unverified) / workers)))
+        batches = [[events[i] for i in unverified[j:j + batch_size]] for j in range(0, len(unverified), batch_size)]
+        verified = []
+        for batch_result in get_executor(workers).map(verify_batch, batches):
+            verified.extend(batch_result)
+
+    for i, valid in zip(unverified, verified):
+        result[i] = valid
+        if valid:
+            __verified_signatures[(events[i].id, events[i].signature)] = None
+    while len(__verified_signatures) > bptc.verified_signatures_cache_size:
+        __verified_signatures.popitem(last=False)
+
+    return result
@@ -36,7 +36,7 @@ version.filename = %(source.dir)s/main.py
 
 # (list) Application requirements
 # comma seperated e.g. requirements = sqlite3,kivy
-requirements = python3crystax,kivy,twisted,libnacl,toposort,dateutil,cachetools
+requirements = python3crystax,kivy,twisted,libnacl,toposort,cachetools
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
@@ -28,6 +28,8 @@ def parse_args():
                         help='Push initially to the given address')
     parser.add_argument('-d', '--debug', action='store_true',
                         help='Store hashgraph in a temporary database for each 200 processed events')
+    parser.add_argument('--verification-workers', type=int, default=bptc.verification_workers,
+                        help='Number of threads verifying the signatures of received events')
     args = parser.parse_args()
     if not args.headless and args.dirty:
         args.dirty = False  # Ignore this flag on every other client
@@ -38,6 +40,7 @@ if __name__ == '__main__':
     cl_args = parse_args()
     bptc.ip = cl_args.ip
     bptc.port = cl_args.port
+    bptc.verification_workers = cl_args.verification_workers
     os.makedirs(cl_args.output, exist_ok=True)
     init_logger(os.path.join(cl_args.output, 'log.txt'), cl_args.verbose)
     if cl_args.console: